@@ -0,0 +1,229 @@
+'''
+Rolling sentiment counts per label, kept in memory.
+Every stored tweet adds one to its label's negative, neutral or
+positive count in a ring of 1 minute buckets (the last hour) and a
+ring of 1 hour buckets (the last two days). "How positive is label X
+in the last 5 minutes" reads 5 buckets instead of the tweet table.
+
+Counts not yet written are also kept per closed bucket and upserted
+into a compact summary table (one row per label, granularity and
+bucket) on an interval, so tweets older than the rings (e.g. a fetch
+of last week) still reach the summary table.
+'''
+from contextlib import nullcontext
+import calendar # Tweet dates to epoch seconds
+from functools import lru_cache # Many tweets share a created_at second
+import sqlite3 # Stand-in database
+import threading # Flush thread
+import time # Bucket times
+
+TABLE = 'sentiment_summary'
+SENTIMENTS = ('negative', 'neutral', 'positive')
+# name: (bucket width in seconds, buckets kept)
+GRANULARITIES = {'minute': (60, 60), 'hour': (3600, 48)}
+
+
+@lru_cache(maxsize=4096)
+def tweet_time(tweet_date):
+    return calendar.timegm(time.strptime(tweet_date, '%a %b %d %H:%M:%S +0000 %Y'))
+
+
+class Ring(object):
+    '''
+    slots buckets of width seconds; a bucket is reused once its
+    time comes round again.
+    '''
+
+    def __init__(self, width, slots):
+        self.width = width
+        self.slots = slots
+        self.starts = [None] * slots
+        self.counts = [[0, 0, 0] for slot in range(slots)]
+
+    # False if the time is older than the ring
+    def add(self, when, sentiment):
+        start = int(when // self.width) * self.width
+        index = (start // self.width) % self.slots
+        current = self.starts[index]
+        if current != start:
+            if current is not None and current > start:
+                return False
+            self.starts[index] = start
+            self.counts[index] = [0, 0, 0]
+        self.counts[index][sentiment] += 1
+        return True
+
+    # Counts of the buckets covering the last seconds up to now
+    def window(self, seconds, now):
+        totals = [0, 0, 0]
+        newest = int(now // self.width) * self.width
+        oldest = newest - (max(1, -(-seconds // self.width)) - 1) * self.width
+        for index in range(self.slots):
+            start = self.starts[index]
+            if start is not None and oldest <= start <= newest:
+                counts = self.counts[index]
+                totals[0] += counts[0]
+                totals[1] += counts[1]
+                totals[2] += counts[2]
+        return totals
+
+
+def summary_upsert_sql(table, sqlite=False):
+    if sqlite:
+        return ("INSERT INTO {0} (LABEL, GRANULARITY, BUCKET_START, NEGATIVE, NEUTRAL, POSITIVE) "
+                "VALUES (:label, :granularity, :bucket_start, :negative, :neutral, :positive) "
+                "ON CONFLICT(LABEL, GRANULARITY, BUCKET_START) DO UPDATE SET "
+                "NEGATIVE = NEGATIVE + excluded.NEGATIVE, NEUTRAL = NEUTRAL + excluded.NEUTRAL, "
+                "POSITIVE = POSITIVE + excluded.POSITIVE").format(table)
+    return """MERGE INTO {0} t
+              USING (SELECT :label LABEL, :granularity GRANULARITY,
+                            TIMESTAMP '1970-01-01 00:00:00' + NUMTODSINTERVAL(:bucket_start, 'SECOND') BUCKET_START,
+                            :negative NEGATIVE, :neutral NEUTRAL, :positive POSITIVE FROM dual) s
+              ON (t.LABEL = s.LABEL AND t.GRANULARITY = s.GRANULARITY AND t.BUCKET_START = s.BUCKET_START)
+              WHEN MATCHED THEN UPDATE SET t.NEGATIVE = t.NEGATIVE + s.NEGATIVE,
+                                           t.NEUTRAL = t.NEUTRAL + s.NEUTRAL,
+                                           t.POSITIVE = t.POSITIVE + s.POSITIVE
+              WHEN NOT MATCHED THEN INSERT (LABEL, GRANULARITY, BUCKET_START, NEGATIVE, NEUTRAL, POSITIVE)
+                                    VALUES (s.LABEL, s.GRANULARITY, s.BUCKET_START,
+                                            s.NEGATIVE, s.NEUTRAL, s.POSITIVE)""".format(table)
+
+
+class SentimentAggregates(object):
+    '''
+    con is a db.ConnectionPool or a sqlite3 connection, as for BatchWriter,
+    or None to keep the counts in memory only.
+        - interval: seconds between summary table flushes
+    Call close() on shutdown to flush what is left.
+    '''
+
+    def __init__(self, con=None, table=TABLE, interval=60.0):
+        self.con = con
+        self.table = table
+        self.interval = interval
+        self.sqlite = isinstance(con, sqlite3.Connection)
+        self.sql = summary_upsert_sql(table, self.sqlite)
+        self.added = 0
+        self.rows_written = 0
+        self._rings = {} # {label: {granularity: Ring}}
+        self._pending = {} # {(label, granularity, bucket start): [neg, neu, pos]}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if con is not None:
+            self.create()
+            self._thread = threading.Thread(target=self._run, name='SentimentAggregates', daemon=True)
+            self._thread.start()
+
+    def _connection(self):
+        if self.sqlite:
+            return nullcontext(self.con)
+        return self.con.connection()
+
+    def create(self):
+        with self._connection() as con:
+            cursor = con.cursor()
+            if self.sqlite:
+                cursor.execute('''create table if not exists {}
+                                (LABEL TEXT, GRANULARITY TEXT, BUCKET_START INTEGER,
+                                 NEGATIVE INTEGER, NEUTRAL INTEGER, POSITIVE INTEGER,
+                                 PRIMARY KEY (LABEL, GRANULARITY, BUCKET_START))'''.format(self.table))
+            else:
+                tables = [table[0].lower() for table in cursor.execute("SELECT table_name from user_tables")]
+                if self.table.lower() not in tables:
+                    cursor.execute('''create table {}
+                                    (LABEL VARCHAR(100),
+                                     GRANULARITY VARCHAR(10),
+                                     BUCKET_START DATE,
+                                     NEGATIVE NUMBER(38),
+                                     NEUTRAL NUMBER(38),
+                                     POSITIVE NUMBER(38),
+                                     PRIMARY KEY (LABEL, GRANULARITY, BUCKET_START))'''.format(self.table))
+            con.commit()
+
+    # sentiment is 'negative', 'neutral' or 'positive'; when is epoch seconds
+    # or a tweet's created_at string, now if None
+    def add(self, label, sentiment, when=None):
+        if when is None:
+            when = time.time()
+        elif isinstance(when, str):
+            when = tweet_time(when)
+        index = SENTIMENTS.index(sentiment)
+        with self._lock:
+            rings = self._rings.get(label)
+            if rings is None:
+                rings = self._rings[label] = {name: Ring(width, slots)
+                                              for name, (width, slots) in GRANULARITIES.items()}
+            for name, ring in rings.items():
+                ring.add(when, index)
+                if self.con is not None:
+                    key = (label, name, int(when // ring.width) * ring.width)
+                    counts = self._pending.get(key)
+                    if counts is None:
+                        counts = self._pending[key] = [0, 0, 0]
+                    counts[index] += 1
+            self.added += 1
+
+    def labels(self):
+        with self._lock:
+            return list(self._rings)
+
+    '''
+    Counts for label over the last seconds (whole buckets, the current
+    one included). Uses minute buckets for up to an hour, hour buckets
+    beyond that.
+    '''
+    def counts(self, label, seconds=300, now=None):
+        now = time.time() if now is None else now
+        name = 'minute' if seconds <= GRANULARITIES['minute'][0] * GRANULARITIES['minute'][1] else 'hour'
+        with self._lock:
+            rings = self._rings.get(label)
+            totals = rings[name].window(seconds, now) if rings else [0, 0, 0]
+        counts = dict(zip(SENTIMENTS, totals))
+        counts['total'] = sum(totals)
+        return counts
+
+    # Fractions of negative, neutral and positive over the last seconds
+    def ratios(self, label, seconds=300, now=None):
+        counts = self.counts(label, seconds, now)
+        total = counts['total']
+        return {sentiment: counts[sentiment] / total if total else 0.0 for sentiment in SENTIMENTS}
+
+    # {label: counts} for every label
+    def snapshot(self, seconds=300, now=None):
+        return {label: self.counts(label, seconds, now) for label in self.labels()}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    # Upserts the counts of closed buckets, or of all buckets if everything
+    def flush(self, everything=False):
+        if self.con is None:
+            return 0
+        now = time.time()
+        rows = []
+        with self._lock:
+            for key in list(self._pending):
+                label, name, start = key
+                if everything or start + GRANULARITIES[name][0] <= now:
+                    negative, neutral, positive = self._pending.pop(key)
+                    rows.append({'label': label, 'granularity': name, 'bucket_start': start,
+                                 'negative': negative, 'neutral': neutral, 'positive': positive})
+        if not rows:
+            return 0
+        with self._db_lock:
+            try:
+                with self._connection() as con:
+                    con.cursor().executemany(self.sql, rows)
+                    con.commit()
+                self.rows_written += len(rows)
+            except Exception as e:
+                print("SentimentAggregates flush error:", e)
+        return len(rows)
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        self.flush(everything=True)
@@ -0,0 +1,398 @@
+'''
+Append-only archive of raw tweet payloads for reprocessing.
+Once a tweet is stored only its derived columns are kept, so re-scoring
+with a better model would mean fetching from Twitter again. RawArchive
+appends every payload as a JSON line to segment files
+(segment-000001.jsonl, ...) and, next to each, a fixed-width index
+(.idx) of (tweet id, tweet time, offset, length).
+
+Index entries are held back until the payloads they point at have
+been flushed to the data file, so the index never gets ahead of the
+data. After a crash, reopening a segment drops index entries past the
+end of the data, indexes whole lines the index missed and cuts off a
+partly written last line.
+
+When a segment is closed, its ids are written sorted, with each one's
+index position, to a .sid file headed by the segment's time range.
+ArchiveReader (needs NumPy) memory-maps the .idx and .sid files as
+arrays instead of loading them: get(id) is a binary search per
+segment and one slice of the data, scan(start, end) skips segments
+outside the date range by their header and picks the entries of the
+others with one vectorized comparison. Only the segment still being
+written has no .sid; its ids are sorted when it is opened. No
+database is involved.
+
+    python3 archive.py [payloads]
+'''
+import glob # Segment files
+import json # One payload per line
+import mmap # Reads
+import os # Segment paths
+import random # Benchmark lookups
+import shutil # Benchmark cleanup
+import struct # Index entries
+import sys # Benchmark arguments
+import tempfile # Benchmark archive
+import threading # Shared by stream workers
+import time # Benchmark timing
+from aggregates import tweet_time # created_at to epoch seconds
+
+try:
+    import orjson # Optional fast serializer
+    dumps = orjson.dumps
+except ImportError:
+    def dumps(data):
+        return json.dumps(data).encode()
+
+try:
+    import numpy as np # Index arrays for ArchiveReader
+except ImportError:
+    np = None
+
+# id, epoch seconds, offset in the segment, length in bytes
+ENTRY = struct.Struct('<QIQI')
+# Sorted id index: first and last tweet time, entry count, then the ids
+# in order as <Q and their index positions as <I
+SORTED_HEADER = struct.Struct('<IIQ')
+if np is not None:
+    ENTRY_DTYPE = np.dtype([('id', '<u8'), ('time', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+
+
+def payload_seconds(data):
+    if 'timestamp_ms' in data:
+        return int(data['timestamp_ms']) // 1000
+    return tweet_time(data['created_at'])
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, 'segment-%06d.jsonl' % number)
+
+
+def index_path(path):
+    return path[:-len('.jsonl')] + '.idx'
+
+
+def sorted_path(path):
+    return path[:-len('.jsonl')] + '.sid'
+
+
+# Sorted id index of a closed segment, written once so readers never sort it
+def write_sorted_index(path):
+    with open(index_path(path), 'rb') as f:
+        index = f.read()
+    entries = list(ENTRY.iter_unpack(index[:len(index) - len(index) % ENTRY.size]))
+    order = sorted(range(len(entries)), key=lambda position: entries[position][0])
+    times = [entry[1] for entry in entries]
+    temporary = sorted_path(path) + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(SORTED_HEADER.pack(min(times, default=0), max(times, default=0), len(entries)))
+        f.write(struct.pack('<%dQ' % len(order), *(entries[position][0] for position in order)))
+        f.write(struct.pack('<%dI' % len(order), *order))
+    os.replace(temporary, sorted_path(path))
+
+
+# Make a segment's index agree with its data after a crash
+def repair_segment(path):
+    # Data lost with its index still there counts as an empty segment
+    open(path, 'ab').close()
+    size = os.path.getsize(path)
+    with open(index_path(path), 'a+b') as f:
+        f.seek(0)
+        index = f.read()
+        keep = len(index) - len(index) % ENTRY.size
+        end = 0
+        # Offsets only grow: drop entries from the back until one fits in the data
+        while keep:
+            tweet_id, seconds, offset, length = ENTRY.unpack_from(index, keep - ENTRY.size)
+            if offset + length < size:
+                end = offset + length + 1
+                break
+            keep -= ENTRY.size
+        entries = []
+        with open(path, 'r+b') as data:
+            data.seek(end)
+            tail = data.read()
+            offset = end
+            for line in tail.splitlines(True):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    payload = json.loads(line)
+                    entries.append(ENTRY.pack(payload['id'], payload_seconds(payload), offset, len(line) - 1))
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+            if offset < size:
+                data.truncate(offset)
+        if keep != len(index) or entries or offset < size:
+            print("Repaired", path + ":", (len(index) - keep) // ENTRY.size, "stale index entries,",
+                  len(entries), "lines indexed,", size - offset, "bytes cut")
+            f.truncate(keep)
+            f.write(b''.join(entries))
+
+
+class RawArchive(object):
+    '''
+    Appends payloads to the newest segment of directory.
+        - segment_bytes: start a new segment once this size is passed
+    Call close() on shutdown to flush the open segment and its index.
+    '''
+
+    def __init__(self, directory='archive', segment_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.archived = 0
+        os.makedirs(directory, exist_ok=True)
+        segments = sorted(glob.glob(os.path.join(directory, 'segment-*.jsonl')))
+        self._number = int(os.path.basename(segments[-1])[8:14]) if segments else 1
+        self.index_every = 4096 # Index entries held before the data is flushed for them
+        self._data = None
+        self._index = None
+        self._pending = []
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        path = segment_path(self.directory, self._number)
+        repair_segment(path)
+        # Reopened after a clean shutdown: the segment grows past its sorted index
+        if os.path.exists(sorted_path(path)):
+            os.remove(sorted_path(path))
+        self._data = open(path, 'ab', buffering=1 << 20)
+        self._index = open(index_path(path), 'ab', buffering=0)
+        self._offset = self._data.tell()
+
+    # Data first, then the entries pointing at it
+    def _write_index(self):
+        self._data.flush()
+        if self._pending:
+            self._index.write(b''.join(self._pending))
+            self._pending = []
+
+    def _close_segment(self):
+        self._write_index()
+        self._data.close()
+        self._index.close()
+        self._data = self._index = None
+        write_sorted_index(segment_path(self.directory, self._number))
+
+    def append(self, data):
+        line = dumps(data) + b'\n'
+        tweet_id, seconds = data['id'], payload_seconds(data)
+        with self._lock:
+            if self._data is None:
+                self._open()
+            self._data.write(line)
+            self._pending.append(ENTRY.pack(tweet_id, seconds, self._offset, len(line) - 1))
+            self._offset += len(line)
+            self.archived += 1
+            if self._offset >= self.segment_bytes:
+                self._close_segment()
+                self._number += 1
+            elif len(self._pending) >= self.index_every:
+                self._write_index()
+
+    def flush(self):
+        with self._lock:
+            if self._data is not None:
+                self._write_index()
+
+    def close(self):
+        with self._lock:
+            if self._data is not None:
+                self._close_segment()
+
+
+class Segment(object):
+    '''
+    One segment as NumPy views over its memory-mapped files, as of when
+    it was opened. Nothing is read until it is used.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        index_size = os.path.getsize(index_path(path))
+        # A partly written last entry is ignored
+        self._count = index_size // ENTRY.size
+        self._maps = []
+        self._entries = None
+        self._ids = None
+        self._positions = None
+        self._range = None
+        self._data = None
+        if os.path.exists(sorted_path(path)):
+            with open(sorted_path(path), 'rb') as f:
+                header = f.read(SORTED_HEADER.size)
+            first, last, count = SORTED_HEADER.unpack(header)
+            # Only a sorted index covering every entry is used
+            if count == self._count:
+                self._range = (first, last)
+
+    def _map(self, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            if not self._count:
+                self._entries = np.zeros(0, dtype=ENTRY_DTYPE)
+            else:
+                entries = np.frombuffer(self._map(index_path(self.path)), dtype=ENTRY_DTYPE, count=self._count)
+                if self._range is None:
+                    # Still being written or not repaired: only entries inside the data
+                    ends = entries['offset'] + entries['length']
+                    entries = entries[:np.searchsorted(ends, self.size)]
+                self._entries = entries
+        return self._entries
+
+    def __len__(self):
+        return self._count if self._range is not None else len(self.entries)
+
+    def _load_ids(self):
+        if self._range is not None and self._count:
+            mapped = self._map(sorted_path(self.path))
+            self._ids = np.frombuffer(mapped, dtype='<u8', count=self._count, offset=SORTED_HEADER.size)
+            self._positions = np.frombuffer(mapped, dtype='<u4', count=self._count,
+                                            offset=SORTED_HEADER.size + 8 * self._count)
+        else:
+            ids = self.entries['id']
+            self._positions = np.argsort(ids, kind='stable')
+            self._ids = np.ascontiguousarray(ids[self._positions])
+
+    # Index position of tweet_id, None if it is not in this segment
+    def find(self, tweet_id):
+        if self._ids is None:
+            self._load_ids()
+        ids = self._ids
+        if not len(ids) or tweet_id < ids[0] or tweet_id > ids[-1]:
+            return None
+        # A uint64 key: an int would convert the whole array to float
+        position = int(ids.searchsorted(np.uint64(tweet_id)))
+        if ids[position] != tweet_id:
+            return None
+        return int(self._positions[position])
+
+    # (first, last) tweet time, None if empty
+    @property
+    def time_range(self):
+        if self._range is None:
+            times = self.entries['time']
+            self._range = (int(times.min()), int(times.max())) if len(times) else (0, 0)
+        return self._range if len(self) else None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._map(self.path) if self.size else b''
+        return self._data
+
+    def read(self, position):
+        entry = self.entries[position]
+        offset = int(entry['offset'])
+        return json.loads(self.data[offset:offset + int(entry['length'])])
+
+    # Index positions with start <= time < end, in archive order
+    def select(self, start=None, end=None):
+        times = self.entries['time']
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times < end
+        return np.flatnonzero(mask)
+
+    def close(self):
+        self._entries = self._ids = self._positions = self._data = None
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                # A caller still holds a slice; the map goes when it does
+                pass
+        self._maps = []
+
+
+class ArchiveReader(object):
+    '''
+    Read-only view of an archive as of when it was opened.
+    Times are seconds since the epoch (UTC).
+    '''
+
+    def __init__(self, directory='archive'):
+        if np is None:
+            raise ImportError("ArchiveReader needs NumPy")
+        paths = sorted(glob.glob(os.path.join(directory, 'segment-*.jsonl')))
+        self.segments = [Segment(path) for path in paths if os.path.exists(index_path(path))]
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    # The payload of a tweet id, None if it was not archived
+    def get(self, tweet_id):
+        for segment in reversed(self.segments):
+            position = segment.find(tweet_id)
+            if position is not None:
+                return segment.read(position)
+        return None
+
+    # Payloads with start <= time < end, in archive order
+    def scan(self, start=None, end=None):
+        for segment in self.segments:
+            time_range = segment.time_range
+            if time_range is None:
+                continue
+            first, last = time_range
+            if (end is not None and first >= end) or (start is not None and last < start):
+                continue
+            for position in segment.select(start, end):
+                yield segment.read(position)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def bench_archive(n=200000):
+    tmp = tempfile.mkdtemp()
+    base = 1561370400
+    payload = {'created_at': 'Mon Jun 24 10:00:00 +0000 2019', 'lang': 'en',
+               'text': 'go rams go ' * 12, 'entities': {'hashtags': [{'text': 'rams'}]},
+               'user': {'screen_name': 'casey', 'followers_count': 10, 'friends_count': 20,
+                        'location': 'Earth'}, 'favorite_count': 0, 'retweet_count': 0}
+    archive = RawArchive(tmp, segment_bytes=32 * 1024 * 1024)
+    start = time.perf_counter()
+    for i in range(n):
+        payload['id'] = i
+        payload['timestamp_ms'] = str((base + i) * 1000)
+        archive.append(payload)
+    archive.close()
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(path) for path in glob.glob(os.path.join(tmp, '*')))
+    print("append:     %10.1f payloads/sec, %.1f MB" % (n / elapsed, size / 1e6))
+
+    start = time.perf_counter()
+    reader = ArchiveReader(tmp)
+    print("open index: %10.3f secs for %d payloads, %d segments" %
+          (time.perf_counter() - start, len(reader), len(reader.segments)))
+    start = time.perf_counter()
+    count = sum(1 for data in reader.scan())
+    elapsed = time.perf_counter() - start
+    print("full scan:  %10.1f payloads/sec, %.1f MB/sec" % (count / elapsed, size / elapsed / 1e6))
+    start = time.perf_counter()
+    count = sum(1 for data in reader.scan(base + n // 2, base + n // 2 + n // 10))
+    print("10%% range:  %10.3f secs for %d payloads" % (time.perf_counter() - start, count))
+    ids = [random.randrange(n) for i in range(10000)]
+    start = time.perf_counter()
+    for tweet_id in ids:
+        assert reader.get(tweet_id)['id'] == tweet_id
+    print("get(id):    %10.1f lookups/sec" % (len(ids) / (time.perf_counter() - start)))
+    reader.close()
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    bench_archive(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,123 @@
+'''
+Content-addressed cache for sentiment results.
+Retweets resolve to the same full text (see Tweet.getText), so most
+of a stream is scored more than once. Results are keyed on a hash of
+the whitespace-normalized text and kept in an in-memory LRU with a TTL, backed by
+an optional sqlite file that survives restarts.
+'''
+from collections import OrderedDict
+import hashlib # Content keys
+import json # Serializing results for the disk tier
+import sqlite3 # Persistent tier
+import threading # Cache is shared by stream workers
+import time # TTL expiry
+
+
+# Bumped when the key changes, so older disk entries are never hit
+KEY_VERSION = '2:'
+
+
+def text_key(text):
+    # Whitespace differences do not change the score; case does (VADER's caps emphasis)
+    normalized = KEY_VERSION + ' '.join(text.split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+class SentimentCache(object):
+    '''
+    Two tier cache of nlp.get_sentiments results.
+        - size: max entries held in memory (least recently used evicted)
+        - ttl: seconds an entry stays valid in either tier (None to keep forever)
+        - path: sqlite file for the persistent tier, or None for memory only
+    '''
+
+    def __init__(self, size=100000, ttl=3600, path=None):
+        self.size = size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (stored_at, result)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('''create table if not exists sentiment_cache
+                                (KEY TEXT PRIMARY KEY,
+                                 STORED_AT REAL,
+                                 RESULT TEXT)''')
+            self._db.commit()
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'hit_ratio': self.hit_ratio,
+                'entries': len(self._entries)}
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get(self, text):
+        key = text_key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0], now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute('select STORED_AT, RESULT from sentiment_cache where KEY = ?',
+                                       (key,)).fetchone()
+                if row and not self._expired(row[0], now):
+                    result = json.loads(row[1])
+                    self._put(key, row[0], result)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return result
+
+            self.misses += 1
+            return None
+
+    def put(self, text, result):
+        self.put_many([text], [result])
+
+    # One disk commit for a whole batch of results
+    def put_many(self, texts, results):
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, result in zip(texts, results):
+                key = text_key(text)
+                self._put(key, now, result)
+                rows.append((key, now, json.dumps(result)))
+            if self._db is not None and rows:
+                self._db.executemany('insert or replace into sentiment_cache values (?, ?, ?)', rows)
+                self._db.commit()
+
+    def _put(self, key, stored_at, result):
+        self._entries[key] = (stored_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('delete from sentiment_cache')
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,143 @@
+'''
+Resume checkpoints for fetch and stream.
+One row per (table, label, term) holds the highest tweet id written
+and that tweet's date. BatchWriter updates it in the same transaction
+as each batch of inserts, so a resume is a primary key lookup instead
+of a scan of the tweet table. Term '*' covers rows with no search term
+(the stream, or a backfill).
+'''
+from contextlib import nullcontext
+import sqlite3 # Stand-in database
+from writer import COLUMNS, ID, KEYWORD, TWEET_DATE # Row layout
+
+TABLE = 'flock_checkpoints'
+DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+class CheckpointStore(object):
+    '''
+    con is a db.ConnectionPool or a sqlite3 connection, as for BatchWriter.
+    '''
+
+    def __init__(self, con):
+        self.con = con
+        self.sqlite = isinstance(con, sqlite3.Connection)
+        self.created = False
+
+    def _connection(self):
+        if self.sqlite:
+            return nullcontext(self.con)
+        return self.con.connection()
+
+    def create(self):
+        with self._connection() as con:
+            cursor = con.cursor()
+            if self.sqlite:
+                cursor.execute('''create table if not exists {}
+                                (TABLE_NAME TEXT, LABEL TEXT, TERM TEXT,
+                                 MAX_ID INTEGER, MAX_DATE TEXT,
+                                 PRIMARY KEY (TABLE_NAME, LABEL, TERM))'''.format(TABLE))
+            else:
+                tables = [table[0].lower() for table in cursor.execute("SELECT table_name from user_tables")]
+                if TABLE not in tables:
+                    cursor.execute('''create table {}
+                                    (TABLE_NAME VARCHAR(128),
+                                     LABEL VARCHAR(100),
+                                     TERM VARCHAR(100),
+                                     MAX_ID NUMBER(25),
+                                     MAX_DATE DATE,
+                                     PRIMARY KEY (TABLE_NAME, LABEL, TERM))'''.format(TABLE))
+            con.commit()
+        self.created = True
+
+    '''
+    Raise the high-water marks for a batch of accepted rows.
+    Runs on the writer's connection and does not commit: the caller
+    commits it together with the inserts.
+    '''
+    def update(self, con, table, rows, terms):
+        marks = {}
+        for row, term in zip(rows, terms):
+            key = (row[KEYWORD], term or '*')
+            if key not in marks or row[ID] > marks[key]['max_id']:
+                marks[key] = {'table_name': table, 'label': key[0], 'term': key[1],
+                              'max_id': row[ID], 'max_date': row[TWEET_DATE]}
+        if not marks:
+            return
+        if self.sqlite:
+            sql = '''INSERT INTO {} (TABLE_NAME, LABEL, TERM, MAX_ID, MAX_DATE)
+                     VALUES (:table_name, :label, :term, :max_id, :max_date)
+                     ON CONFLICT (TABLE_NAME, LABEL, TERM) DO UPDATE
+                     SET MAX_ID = excluded.MAX_ID, MAX_DATE = excluded.MAX_DATE
+                     WHERE excluded.MAX_ID > MAX_ID'''.format(TABLE)
+        else:
+            sql = '''MERGE INTO {} c
+                     USING (SELECT :table_name TABLE_NAME, :label LABEL, :term TERM,
+                                   :max_id MAX_ID,
+                                   to_date(:max_date, 'Dy Mon dd hh24:mi:ss "+0000" yyyy') MAX_DATE
+                            FROM dual) s
+                     ON (c.TABLE_NAME = s.TABLE_NAME AND c.LABEL = s.LABEL AND c.TERM = s.TERM)
+                     WHEN MATCHED THEN UPDATE SET c.MAX_ID = s.MAX_ID, c.MAX_DATE = s.MAX_DATE
+                                       WHERE s.MAX_ID > c.MAX_ID
+                     WHEN NOT MATCHED THEN INSERT (TABLE_NAME, LABEL, TERM, MAX_ID, MAX_DATE)
+                          VALUES (s.TABLE_NAME, s.LABEL, s.TERM, s.MAX_ID, s.MAX_DATE)'''.format(TABLE)
+        con.cursor().executemany(sql, list(marks.values()))
+
+    # Returns {(label, term): (max_id, max_date)} for a tweet table
+    def get(self, table):
+        with self._connection() as con:
+            cursor = con.cursor()
+            cursor.execute('select LABEL, TERM, MAX_ID, MAX_DATE from {} where TABLE_NAME = :table_name'
+                           .format(TABLE), {'table_name': table})
+            return {(label, term): (max_id, max_date) for label, term, max_id, max_date in cursor}
+
+    '''
+    since_id for each search term: its own mark if it has one,
+    otherwise the mark of its label
+    '''
+    def since_ids(self, table, groups):
+        marks = self.get(table)
+        since_ids = {}
+        for label, terms in groups.items():
+            for term in terms:
+                mark = marks.get((label, term)) or marks.get((label, '*'))
+                if mark:
+                    since_ids[term] = max(mark[0], since_ids.get(term, 0))
+        return since_ids
+
+    '''
+    One-time build of the label marks of an existing tweet table.
+    Adds a (KEYWORD, ID) index so each label's MAX(ID) is an index lookup.
+    '''
+    def backfill(self, table):
+        if not self.created:
+            self.create()
+        index = '{}_kw_id'.format(table)
+        with self._connection() as con:
+            cursor = con.cursor()
+            if self.sqlite:
+                cursor.execute('create index if not exists {} on {} (KEYWORD, ID)'.format(index, table))
+            else:
+                indexes = [row[0].lower() for row in cursor.execute("SELECT index_name from user_indexes")]
+                if index.lower() not in indexes:
+                    cursor.execute('create index {} on {} (KEYWORD, ID)'.format(index, table))
+            labels = [row[0] for row in cursor.execute('select distinct KEYWORD from {}'.format(table))]
+            rows = []
+            for label in labels:
+                cursor.execute('select max(ID) from {} where KEYWORD = :label'.format(table),
+                               {'label': label})
+                max_id = cursor.fetchone()[0]
+                if max_id is None:
+                    continue
+                cursor.execute('select TWEET_DATE from {} where KEYWORD = :label and ID = :id'
+                               .format(table), {'label': label, 'id': max_id})
+                max_date = cursor.fetchone()[0]
+                if not self.sqlite:
+                    max_date = max_date.strftime(DATE_FORMAT)
+                row = [None] * len(COLUMNS)
+                row[ID], row[TWEET_DATE], row[KEYWORD] = max_id, max_date, label
+                rows.append(row)
+            self.update(con, table, rows, ['*'] * len(rows))
+            con.commit()
+        print("Backfilled checkpoints for", len(rows), "labels of", table)
+        return len(rows)
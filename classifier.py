@@ -0,0 +1,152 @@
+'''
+Offline sentiment classifier, in place of the text-processing.com call.
+Multinomial Naive Bayes over nlp.tokenize tokens (lowercased), with the
+same negative/neutral/positive labels as the URL. A batch is scored with
+one gather of per-token log probabilities and a bincount per label.
+
+The model implements classify/classify_many/close like
+nlp.SentimentClient, so nlp.set_client(classifier.load('model.npz'))
+(or Flock(sentiment_model='model.npz')) replaces the network round trip.
+
+    python3 classifier.py train labelled.jsonl model.npz
+    python3 classifier.py bench model.npz corpus.jsonl
+
+labelled.jsonl has one {"text": ..., "sentiment": "negative|neutral|positive"}
+per line.
+'''
+from collections import Counter # Token counts
+import json # Labelled samples
+import random # Held-out split
+import sys # Command line
+import time # Benchmark timing
+import numpy as np
+import nlp # Tokenizer
+
+LABELS = ('negative', 'neutral', 'positive')
+
+
+def read_labelled(path):
+    texts, labels = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                texts.append(data['text'])
+                labels.append(data.get('sentiment') or data['label'])
+    return texts, labels
+
+
+class NaiveBayes(object):
+    '''
+    vocabulary: tokens in id order
+    log_prior: (3,) log P(label)
+    log_likelihood: (len(vocabulary), 3) log P(token | label)
+    '''
+
+    def __init__(self, vocabulary, log_prior, log_likelihood):
+        self.vocabulary = list(vocabulary)
+        self.ids = {token: index for index, token in enumerate(self.vocabulary)}
+        self.log_prior = np.asarray(log_prior, dtype=np.float32)
+        self.log_likelihood = np.asarray(log_likelihood, dtype=np.float32)
+
+    @classmethod
+    def train(cls, texts, labels, min_count=2, alpha=1.0):
+        tokens = list(nlp.tokenize_batch(texts))
+        totals = Counter(token for text_tokens in tokens for token in text_tokens)
+        vocabulary = sorted(token for token, count in totals.items() if count >= min_count)
+        ids = {token: index for index, token in enumerate(vocabulary)}
+        counts = np.zeros((len(vocabulary), len(LABELS)), dtype=np.float64)
+        label_counts = np.zeros(len(LABELS), dtype=np.float64)
+        for text_tokens, label in zip(tokens, labels):
+            column = LABELS.index(label)
+            label_counts[column] += 1
+            for token in text_tokens:
+                index = ids.get(token)
+                if index is not None:
+                    counts[index, column] += 1
+        counts += alpha
+        log_likelihood = np.log(counts / counts.sum(axis=0))
+        log_prior = np.log((label_counts + 1) / (label_counts.sum() + len(LABELS)))
+        return cls(vocabulary, log_prior, log_likelihood)
+
+    # (len(texts), 3) unnormalized log posteriors
+    def scores(self, texts):
+        ids = self.ids
+        token_ids, rows = [], []
+        for row, text_tokens in enumerate(nlp.tokenize_batch(texts)):
+            for token in text_tokens:
+                index = ids.get(token)
+                if index is not None:
+                    token_ids.append(index)
+                    rows.append(row)
+        scores = np.tile(self.log_prior, (len(texts), 1))
+        if token_ids:
+            gathered = self.log_likelihood[np.asarray(token_ids)]
+            rows = np.asarray(rows)
+            for column in range(len(LABELS)):
+                scores[:, column] += np.bincount(rows, weights=gathered[:, column], minlength=len(texts))
+        return scores
+
+    def predict_proba(self, texts):
+        scores = self.scores(texts)
+        scores -= scores.max(axis=1, keepdims=True)
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def classify_many(self, texts):
+        if not texts:
+            return []
+        return [LABELS[column] for column in self.scores(texts).argmax(axis=1)]
+
+    def classify(self, text):
+        return self.classify_many([text])[0]
+
+    def close(self):
+        pass
+
+    def save(self, path):
+        np.savez_compressed(path, vocabulary=np.array('\n'.join(self.vocabulary)),
+                            log_prior=self.log_prior, log_likelihood=self.log_likelihood)
+
+
+def load(path):
+    with np.load(path) as model:
+        vocabulary = str(model['vocabulary'])
+        return NaiveBayes(vocabulary.split('\n') if vocabulary else [],
+                          model['log_prior'], model['log_likelihood'])
+
+
+def train(path, model_path, holdout=0.1, seed=0):
+    texts, labels = read_labelled(path)
+    samples = list(zip(texts, labels))
+    random.Random(seed).shuffle(samples)
+    split = int(len(samples) * holdout)
+    test, training = samples[:split], samples[split:]
+    model = NaiveBayes.train([text for text, label in training], [label for text, label in training])
+    if test:
+        predicted = model.classify_many([text for text, label in test])
+        correct = sum(prediction == label for prediction, (text, label) in zip(predicted, test))
+        print("Held-out accuracy: %d/%d (%.1f%%)" % (correct, len(test), 100.0 * correct / len(test)))
+    # Keep everything for the saved model
+    model = NaiveBayes.train(texts, labels)
+    model.save(model_path)
+    print("Saved", len(model.vocabulary), "tokens to", model_path)
+    return model
+
+
+def bench_classifier(model_path, corpus_path, batch_size=1000):
+    model = load(model_path)
+    texts = nlp.load_corpus(corpus_path)
+    start = time.perf_counter()
+    for offset in range(0, len(texts), batch_size):
+        model.classify_many(texts[offset:offset + batch_size])
+    elapsed = time.perf_counter() - start
+    print("classify_many: %d texts, %.1f texts/sec" % (len(texts), len(texts) / elapsed))
+
+
+if __name__ == '__main__':
+    commands = {'train': train, 'bench': bench_classifier}
+    if len(sys.argv) != 4 or sys.argv[1] not in commands:
+        print('Usage:', sys.argv[0], 'train labelled.jsonl model.npz | bench model.npz corpus.jsonl')
+        sys.exit(1)
+    commands[sys.argv[1]](sys.argv[2], sys.argv[3])
@@ -0,0 +1,78 @@
+'''
+Lazily created session pool for the Autonomous Database.
+Nothing connects until the first connection() call, so importing
+flock (fetch-only jobs, tools, tests) does not touch the database.
+cx_Oracle is only imported then too, so sqlite stand-ins run without it.
+'''
+from contextlib import contextmanager
+import json # Loading database credentials
+import threading # Pool is created on first use from any thread
+
+# Errors meaning the session is gone and should not go back to the pool
+DISCONNECT_CODES = {28, 1012, 3113, 3114, 3135, 12153, 12537, 12541, 12547, 12570}
+
+
+def is_disconnect(error):
+    args = getattr(error, 'args', ())
+    if not args or not hasattr(args[0], 'code'):
+        return False
+    return args[0].code in DISCONNECT_CODES or str(args[0].message).startswith('DPI-1080')
+
+
+class ConnectionPool(object):
+    '''
+    Wraps a cx_Oracle.SessionPool that is only built on first use.
+        - creds: path to a json file (or a dict) with "user", "pass" and "dsn"
+        - size: max sessions, set to the number of threads that write
+        - ping_interval: idle seconds after which a session is pinged on acquire
+        - timeout: idle seconds after which the pool closes a session
+    '''
+
+    def __init__(self, creds, size=4, ping_interval=60, timeout=300):
+        self.creds = creds
+        self.size = size
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                import cx_Oracle # For connecting to ADB
+                creds = self.creds
+                if type(creds) is not dict:
+                    with open(creds, 'r') as f:
+                        creds = json.load(f)
+                self._pool = cx_Oracle.SessionPool(creds['user'], creds['pass'], creds['dsn'],
+                                                   min=1, max=self.size, increment=1,
+                                                   threaded=True,
+                                                   getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+                self._pool.timeout = self.timeout
+                # Sessions idle past ping_interval are checked (and replaced) on acquire
+                self._pool.ping_interval = self.ping_interval
+            return self._pool
+
+    # Acquire a session for the current thread, released when the block exits
+    @contextmanager
+    def connection(self):
+        import cx_Oracle # Loaded by self.pool
+        pool = self.pool
+        con = pool.acquire()
+        try:
+            yield con
+        except cx_Oracle.DatabaseError as e:
+            if is_disconnect(e):
+                pool.drop(con)
+                con = None
+            raise
+        finally:
+            if con is not None:
+                pool.release(con)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close(force=True)
+                self._pool = None
@@ -0,0 +1,114 @@
+'''
+Tweet id deduplication ahead of parsing, scoring and inserting.
+The same status comes back from several search terms, overlapping
+pages and stream reconnects. Recent ids are kept exactly in a bounded
+set; every id also goes into a Bloom filter so long runs stay covered
+in fixed memory, at a configurable false positive rate.
+'''
+from collections import deque
+import hashlib # Bloom filter hashes
+import math # Bloom filter sizing
+import threading # Shared by the stream and fetch
+
+
+class BloomFilter(object):
+    '''
+    Sized for capacity items at false positive rate fp_rate.
+    '''
+
+    def __init__(self, capacity=10000000, fp_rate=0.001):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    # Adds item, returns True if it was (probably) already there
+    def add(self, item):
+        bits = self.bits
+        present = True
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class Deduper(object):
+    '''
+        - recent: ids held exactly (oldest forgotten first)
+        - capacity, fp_rate: Bloom filter sizing for the long run
+    seen(id) records the id and says whether it was already seen. Callers
+    that may still lose the tweet check with contains(id) and add(id) once
+    it is safely handed on, so a redelivery is not skipped.
+    '''
+
+    def __init__(self, recent=100000, capacity=10000000, fp_rate=0.001):
+        self.recent = recent
+        self.checked = 0
+        self.duplicates = 0
+        self.exact_hits = 0
+        self.bloom_hits = 0
+        self._ids = set()
+        self._order = deque()
+        self._bloom = BloomFilter(capacity, fp_rate) if capacity else None
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'checked': self.checked, 'duplicates': self.duplicates,
+                'exact_hits': self.exact_hits, 'bloom_hits': self.bloom_hits}
+
+    # Whether tweet_id was recorded before, without recording it
+    def contains(self, tweet_id):
+        with self._lock:
+            return self._contains(tweet_id)
+
+    # Record tweet_id once it has been handled
+    def add(self, tweet_id):
+        with self._lock:
+            self._add(tweet_id)
+
+    def seen(self, tweet_id):
+        with self._lock:
+            if self._contains(tweet_id):
+                return True
+            self._add(tweet_id)
+            return False
+
+    def _contains(self, tweet_id):
+        self.checked += 1
+        if tweet_id in self._ids:
+            self.duplicates += 1
+            self.exact_hits += 1
+            return True
+        if self._bloom is not None and tweet_id in self._bloom:
+            self.duplicates += 1
+            self.bloom_hits += 1
+            return True
+        return False
+
+    def _add(self, tweet_id):
+        if tweet_id in self._ids:
+            return
+        self._ids.add(tweet_id)
+        self._order.append(tweet_id)
+        if len(self._order) > self.recent:
+            self._ids.discard(self._order.popleft())
+        if self._bloom is not None:
+            self._bloom.add(tweet_id)
@@ -0,0 +1,112 @@
+'''
+Buffered JSONL log for tweets that matched no label ("misc").
+log() only samples and queues the payload; a background thread does
+the serializing, writing and rotation. Each file starts with one
+"groups" record instead of repeating the groups dict per tweet.
+
+Files rotate to errors.jsonl.1, .2, ... (gzipped if compress) once
+they pass max_bytes; the oldest beyond backups is removed.
+'''
+import datetime # Record timestamps
+import gzip # Compressing rotated files
+import json # One record per line
+import os # Rotation
+import queue # Hand-off from the hot path
+import random # Sampling
+import shutil # Copying into gzip files
+import threading # Background writer
+from matcher import iter_fields # Searchable text of a tweet
+
+
+class ErrorLog(object):
+    '''
+        - groups: the query groups, written at the top of every file
+        - max_bytes: rotate once the file passes this size
+        - backups: rotated files to keep
+        - compress: gzip rotated files
+        - sample: fraction of misc tweets to keep (1.0 keeps all)
+    '''
+
+    def __init__(self, path='errors.jsonl', groups=None, max_bytes=50 * 1024 * 1024,
+                 backups=5, compress=True, sample=1.0, queue_size=10000):
+        self.path = path
+        self.groups = groups
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.sample = sample
+        self.logged = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name='ErrorLog', daemon=True)
+        self._thread.start()
+
+    # Called on the hot path: no I/O or serialization here
+    def log(self, source, raw):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            self.sampled_out += 1
+            return
+        try:
+            self._queue.put_nowait((datetime.datetime.now(), source, raw))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        self._file = open(self.path, 'a', buffering=1 << 16)
+        if self._file.tell() == 0:
+            self._file.write(json.dumps({'type': 'groups', 'time': str(datetime.datetime.now()),
+                                         'groups': self.groups}) + '\n')
+
+    def _rotated(self, index):
+        return '{}.{}{}'.format(self.path, index, '.gz' if self.compress else '')
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        oldest = self._rotated(self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._rotated(index)):
+                os.rename(self._rotated(index), self._rotated(index + 1))
+        if self.compress:
+            with open(self.path, 'rb') as src, gzip.open(self._rotated(1), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, self._rotated(1))
+
+    def _write(self, item):
+        error_time, source, raw = item
+        if self._file is None:
+            self._open()
+        self._file.write(json.dumps({'type': 'misc', 'time': str(error_time), 'source': source,
+                                     'id': raw.get('id'), 'fields': list(iter_fields(raw)),
+                                     'data': raw}) + '\n')
+        self.logged += 1
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(item)
+                # Flush once the burst is written, not per record
+                if self._queue.empty() and self._file is not None:
+                    self._file.flush()
+            except Exception as e:
+                print("ErrorLog write error:", e)
+            finally:
+                self._queue.task_done()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
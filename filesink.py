@@ -0,0 +1,186 @@
+'''
+File output for tweet rows, in place of an ADB table.
+Rows are the same tuples BatchWriter takes (COLUMNS order) and are
+written as JSON lines for .jsonl/.json names and as CSV (with a
+header) for any other, through one buffered handle kept open between
+rows. The live file is plain text; only rotated files are gzipped.
+
+Files rotate by size and/or age to <name>.<YYYYmmdd-HHMMSS><ext>,
+gzipped on a background thread if compress, so the writer never
+waits on compression. Flushing is up to the caller: flush_every rows,
+flush() whenever, and always on rotate and close.
+
+    python3 filesink.py [rows]
+'''
+import csv # CSV rows
+import datetime # Rotated file names
+import gzip # Compressing rotated files
+import json # JSONL rows
+import os # Rotation
+import shutil # Copying into gzip files
+import sys # Benchmark arguments
+import tempfile # Benchmark files
+import threading # Shared by stream workers, background compression
+import time # Rotation age
+from writer import COLUMNS # Row layout
+
+
+# Output names that are files rather than ADB tables
+def is_file(path):
+    return path.endswith(('.csv', '.jsonl', '.json'))
+
+
+def file_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+# Last row written to a CSV or JSONL file as a list in COLUMNS order, None if empty
+def last_row(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    # Read back from the end one line at a time, without reading the file
+    # Credit: Dave @ https://bit.ly/2JGPcUw
+    jsonl = file_format(path) == 'jsonl'
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell() - 1 # Past the trailing newline
+        while True:
+            while position > 0:
+                f.seek(position - 1)
+                if f.read(1) == b'\n':
+                    break
+                position -= 1
+            f.seek(position)
+            tail = f.read().decode()
+            if jsonl:
+                data = json.loads(tail)
+                return [data.get(column) for column in COLUMNS]
+            # A quoted field can hold newlines: go back until the tail is one whole row
+            rows = list(csv.reader(tail.splitlines(True)))
+            if len(rows) == 1 and len(rows[0]) == len(COLUMNS):
+                return None if rows[0] == COLUMNS else rows[0]
+            if position <= 0:
+                return None
+            position -= 1
+
+class FileWriter(object):
+    '''
+    Same interface as writer.BatchWriter: add(row, term), flush(), close().
+        - max_bytes: rotate once the file passes this size (0 for never)
+        - max_age: rotate files open this many seconds (0 for never)
+        - compress: gzip rotated files
+        - flush_every: rows between flushes to the OS (0 leaves it to the buffer)
+    '''
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age=0, compress=False,
+                 flush_every=0, buffer_size=1 << 20):
+        if path.endswith('.gz'):
+            raise ValueError("Can't write rows to " + path + ": the live file is plain text, "
+                             "use compress=True to gzip rotated files")
+        self.path = path
+        self.table = path
+        self.format = file_format(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.flush_every = flush_every
+        self.buffer_size = buffer_size
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.rotations = 0
+        self._file = None
+        self._csv = None
+        self._bytes = 0
+        self._opened = 0.0
+        self._unflushed = 0
+        self._compressors = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self._file = open(self.path, 'a', newline='', encoding='utf-8', buffering=self.buffer_size)
+        self._bytes = self._file.tell()
+        self._opened = time.monotonic()
+        if self.format == 'csv':
+            self._csv = csv.writer(self._file, quoting=csv.QUOTE_MINIMAL)
+            if self._bytes == 0:
+                self._bytes += self._csv.writerow(COLUMNS)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        root, ext = os.path.splitext(self.path)
+        rotated = '{}.{}{}'.format(root, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), ext)
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = '{}.{}-{}{}'.format(root, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                                          suffix, ext)
+            suffix += 1
+        os.rename(self.path, rotated)
+        self.rotations += 1
+        if self.compress:
+            thread = threading.Thread(target=self._gzip, args=(rotated,), daemon=True)
+            thread.start()
+            self._compressors = [t for t in self._compressors if t.is_alive()] + [thread]
+
+    @staticmethod
+    def _gzip(path):
+        with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+
+    def add(self, row, term=None):
+        with self._lock:
+            if self._file is None:
+                self._open()
+            if self.format == 'csv':
+                self._bytes += self._csv.writerow(row)
+            else:
+                line = json.dumps(dict(zip(COLUMNS, row))) + '\n'
+                self._file.write(line)
+                self._bytes += len(line)
+            self.rows_written += 1
+            self._unflushed += 1
+            if self.flush_every and self._unflushed >= self.flush_every:
+                self._file.flush()
+                self._unflushed = 0
+            if (self.max_bytes and self._bytes >= self.max_bytes) or \
+               (self.max_age and time.monotonic() - self._opened >= self.max_age):
+                self._rotate()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._unflushed = 0
+        return 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        for thread in self._compressors:
+            thread.join()
+
+
+def bench_filesink(n=500000):
+    row = (1, 'Thu Jun 20 18:00:00 +0000 2019', "['rams']", 'go rams go, "beat the niners"', 'casey',
+           10, 20, 0, 0, 'Earth', 'rams', 0, 0, 1)
+    tmp = tempfile.mkdtemp()
+    for name, kwargs in (('rows.csv', {}), ('rows.jsonl', {}),
+                         ('rotating.csv', {'max_bytes': 16 * 1024 * 1024, 'compress': True})):
+        sink = FileWriter(os.path.join(tmp, name), **kwargs)
+        start = time.perf_counter()
+        for i in range(n):
+            sink.add((i,) + row[1:])
+        sink.flush()
+        elapsed = time.perf_counter() - start
+        sink.close()
+        print("%-13s %10.1f rows/sec (%.0f rows/min), %d rotations" %
+              (name, n / elapsed, n / elapsed * 60, sink.rotations))
+    print("Last row:", last_row(os.path.join(tmp, 'rows.csv'))[:2])
+    shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    bench_filesink(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -4,19 +4,32 @@ Created June 20, 2019 by Casey Key, Oracle SE Intern
 Go Rams!
 '''
 from collections import Counter # For term frequencies
-import csv # Exporting tweets
-import cx_Oracle # For connecting to ADB
+import aggregates # Rolling sentiment counts per label
+import archive # Raw payloads for reprocessing
+import checkpoint # Resume points per label and term
 import datetime # Calculate rate of tweets
+import dedup # Skipping repeated statuses
+import db # Pooled connections to ADB
+import errorlog # Logging misc tweets
+import filesink # CSV/JSONL output
 import json # Loading twitter credentials
+import metrics # Per-stage latency histograms
 import os # For finding console width
-import pprint # For printing dicts such as Tweet data
+import prefilter # Skipping raw stream lines before decoding
+import queue # Work queue between the stream and processing
 import re # For removing useless parts of Tweet text
+import scheduler # Concurrent, rate limited search
 import requests # For retrieving sentiment from api
 import sys # For keyword 'track' arguments
+import threading # Stream processing workers
 import time # For finding last tweet in previous fetch
 from twython import Twython, TwythonStreamer # Gateway to Twitter
+from twython.helpers import _transparent_params # Encoding raw stream parameters
 from urllib3.exceptions import ProtocolError # For handling IncompleteRead error
+from matcher import KeywordMatcher # Labelling tweets by keyword
 import nlp # Custom module containing text analysis tools 
+from replay import Recorder # Recording raw payloads
+import writer # Batched inserts
 
 
 '''
@@ -31,8 +44,103 @@ def load_creds(json_creds):
 
 
 
-creds = load_creds('twitter-creds.json')
-con = cx_Oracle.connect(creds['user'], creds['pass'], dsn=creds['dsn'])
+# Sessions are only opened on the first write, see db.ConnectionPool
+pool = db.ConnectionPool('twitter-creds.json')
+
+'''
+One BatchWriter per table, shared by every Tweet, or a FileWriter
+if the "table" is a .csv/.jsonl file.
+close_writers() flushes whatever is still buffered.
+'''
+writers = {}
+writers_lock = threading.Lock() # Stream workers ask for writers concurrently
+# High-water marks per table/label/term, committed with each batch
+checkpoints = checkpoint.CheckpointStore(pool)
+
+# Outputs written as files whatever their extension (Flock's output.txt)
+file_outputs = set()
+
+def get_writer(table):
+    with writers_lock:
+        if table not in writers and (table in file_outputs or filesink.is_file(table)):
+            writers[table] = filesink.FileWriter(table)
+        if table not in writers:
+            if not checkpoints.created:
+                checkpoints.create()
+            writers[table] = writer.BatchWriter(pool, table, checkpoints=checkpoints)
+        return writers[table]
+
+'''
+Term frequencies for every stored tweet are counted in memory and
+upserted into tweet_freqs on an interval.
+'''
+freq_writers = {}
+
+def get_freq_writer(table='tweet_freqs'):
+    with writers_lock:
+        if table not in freq_writers:
+            create_freq_db(table)
+            freq_writers[table] = writer.FreqWriter(pool, table)
+        return freq_writers[table]
+
+'''
+Misc (unlabelled) tweets go to a buffered, rotating JSONL log
+'''
+error_logs = {}
+
+def get_error_log(groups, path='errors.jsonl'):
+    with writers_lock:
+        if path not in error_logs:
+            error_logs[path] = errorlog.ErrorLog(path, groups=groups)
+        return error_logs[path]
+
+'''
+Rolling sentiment counts per label for dashboards, with closed
+buckets upserted into a summary table. memory=True (tweets going to
+a file) keeps the counts in memory only.
+'''
+summaries = {}
+
+def get_aggregates(table=aggregates.TABLE, memory=False):
+    with writers_lock:
+        if table not in summaries:
+            summaries[table] = aggregates.SentimentAggregates(None if memory else pool, table)
+            metrics.gauge('sentiment_5m', summaries[table].snapshot)
+        return summaries[table]
+
+'''
+Raw payload of every Tweet, appended to segment files so stored
+tweets can be reprocessed later. Off unless set_archive is called.
+'''
+raw_archive = None
+
+def set_archive(directory):
+    global raw_archive
+    if raw_archive is not None:
+        raw_archive.close()
+    raw_archive = archive.RawArchive(directory) if directory else None
+
+def close_writers():
+    for table_writer in writers.values():
+        table_writer.close()
+        print("Wrote", table_writer.rows_written, "rows to", table_writer.table,
+              "(" + str(table_writer.rows_rejected), "rejected)")
+    writers.clear()
+    for freq_writer in freq_writers.values():
+        freq_writer.close()
+        print("Counted", freq_writer.tokens_counted, "tokens into", freq_writer.table)
+    freq_writers.clear()
+    for summary in summaries.values():
+        summary.close()
+        print("Summarized", summary.added, "tweets into", summary.table)
+    summaries.clear()
+    for error_log in error_logs.values():
+        error_log.close()
+        print("Logged", error_log.logged, "misc tweets to", error_log.path)
+    error_logs.clear()
+    if raw_archive is not None:
+        raw_archive.close()
+        print("Archived", raw_archive.archived, "raw tweets to", raw_archive.directory)
 
 def get_search_terms(): 
     '''
@@ -98,39 +206,62 @@ def get_search_terms():
 
 def create_stream_db(name):
     # View all tables
-    cursor = con.cursor()
-    tables = cursor.execute("SELECT table_name from user_tables")
-    tables = [table[0].lower() for table in tables]
-    print("Tables\n" + '-'*10)
-    for table in tables:
-        print(table)
-    if name.lower() not in tables:
-        sql = '''create table {}
-                (ID NUMBER(25),
-                 TWEET_DATE date,
-                 HASHTAGS VARCHAR(400),
-                 TEXT VARCHAR(400),
-                 TWITTER_USER VARCHAR(28),
-                 FOLLOWERS NUMBER(10),
-                 FOLLOWING NUMBER(10),
-                 FAVORITE_COUNT NUMBER(6),
-                 RETWEET_COUNT NUMBER(8),
-                 USER_LOC VARCHAR(28),
-                 KEYWORD VARCHAR(100),
-                 NEGATIVE NUMBER(2),
-                 NEUTRAL NUMBER(2),
-                 POSITIVE NUMBER(2))'''.format(name)
-        cursor.execute(sql)
+    with pool.connection() as con:
+        cursor = con.cursor()
+        tables = cursor.execute("SELECT table_name from user_tables")
+        tables = [table[0].lower() for table in tables]
+        print("Tables\n" + '-'*10)
+        for table in tables:
+            print(table)
+        if name.lower() not in tables:
+            sql = '''create table {}
+                    (ID NUMBER(25),
+                     TWEET_DATE date,
+                     HASHTAGS VARCHAR(400),
+                     TEXT VARCHAR(400),
+                     TWITTER_USER VARCHAR(28),
+                     FOLLOWERS NUMBER(10),
+                     FOLLOWING NUMBER(10),
+                     FAVORITE_COUNT NUMBER(6),
+                     RETWEET_COUNT NUMBER(8),
+                     USER_LOC VARCHAR(28),
+                     KEYWORD VARCHAR(100),
+                     NEGATIVE NUMBER(2),
+                     NEUTRAL NUMBER(2),
+                     POSITIVE NUMBER(2))'''.format(name)
+            cursor.execute(sql)
 
     return
 
 
 class Flock(object):
 
-    def __init__(self, json_creds, output, cont):
+    def __init__(self, json_creds, output, cont, workers=4, freqs=True, record=None,
+                 metrics_interval=60, metrics_port=None, dedup_fp_rate=0.001, nlp_processes=0,
+                 raw_stream=False, archive_dir=None, cascade=None, sentiment_model=None,
+                 shedder=None):
+        if output != 'adb' and output.endswith('.gz'):
+            raise ValueError("Output " + output + " would be plain text, drop the .gz")
         self._creds =  load_creds(json_creds)
-        self._output = output # Output type ('csv' or 'adb')
+        # TextBlob and VADER on this many processes, 0 scores on the worker threads
+        nlp.set_processes(nlp_processes)
+        # nlp.Cascade: skip scorers once the answer is clear, None runs all of them
+        nlp.set_cascade(cascade)
+        # Local classifier file in place of the text-processing.com call
+        if sentiment_model:
+            import classifier # Needs NumPy
+            nlp.set_client(classifier.load(sentiment_model))
+        # Keep raw payloads in an append-only archive, off if None
+        set_archive(archive_dir)
+        # One session per worker plus the writer and main threads
+        pool.size = workers + 2
+        self._output = output # 'adb' or an output file (.jsonl/.json, anything else is CSV)
         self._cont = cont # Continue last query
+        self._freqs = freqs # Count term frequencies of saved tweets
+        self._metrics_interval = metrics_interval # Seconds between metrics log lines
+        self._metrics_port = metrics_port # Local HTTP metrics endpoint, off if None
+        # Drops statuses already seen from other terms, pages or reconnects
+        self._deduper = dedup.Deduper(fp_rate=dedup_fp_rate)
         if self._output == 'adb':
             with open('db.txt', 'r+') as db:
                 if sys.stdout.isatty():
@@ -139,13 +270,22 @@ class Flock(object):
                 else:
                     self._table = db.read().strip()
             create_stream_db(self._table)
+        else:
+            # Rows go to a CSV/JSONL file; frequencies need the database
+            self._table = output
+            file_outputs.add(output)
+            self._freqs = freqs = False
         
         with open('./query.txt', 'r') as query:
             self._groups = get_search_terms() if not cont else json.load(query)
+        self._matcher = KeywordMatcher(self._groups)
 
         self._streamer = Streamer(self._creds['CONSUMER_KEY'], self._creds['CONSUMER_SECRET'],
                                   self._creds['ACCESS_KEY'], self._creds['ACCESS_SECRET'],
-                                  groups=self._groups, output=self._table)
+                                  groups=self._groups, output=self._table,
+                                  workers=workers, freqs=freqs,
+                                  recorder=Recorder(record) if record else None,
+                                  deduper=self._deduper, raw=raw_stream, shedder=shedder)
     
     # Flock().tracks = [term1, term2, ..., termN]
     @property
@@ -166,6 +306,11 @@ class Flock(object):
 
         stream = self._streamer
         stream.quiet = quiet
+        stream.start_workers()
+        if self._metrics_interval:
+            metrics.start_reporter(self._metrics_interval)
+        if self._metrics_port:
+            metrics.serve(self._metrics_port)
 
         # try/catch for clean exit after Ctrl-C
         try:
@@ -180,9 +325,20 @@ class Flock(object):
                     continue
             
         except (KeyboardInterrupt, SystemExit):
+            stream.stop_workers()
+            nlp.set_processes(0)
+            close_writers()
+            if stream.recorder:
+                stream.recorder.close()
+            print("Skipped {duplicates} duplicate tweets of {checked}".format(**self._deduper.stats))
+            if stream.shedder:
+                print("Stored per shedding level:", stream.shedder.stats['stored'])
             print("\nSaved", stream.total_tweets, "tweets in", stream.duration)
-            cursor = con.cursor()
-            print(next(iter(cursor.execute('select count(*) from TWEETS')))[0])
+            if self._output == 'adb':
+                with pool.connection() as con:
+                    cursor = con.cursor()
+                    print(next(iter(cursor.execute('select count(*) from TWEETS')))[0])
+            pool.close()
     
 
     
@@ -197,113 +353,133 @@ class Flock(object):
         # input("Press enter to continue.")
         
         last_date = datetime.datetime.now()
+        since_ids = {}
         if self._cont:
-            if csv:
-                # Read last line (Tweet) in output file
-                # Credit: Dave @ https://bit.ly/2JGPcUw
-                with open(self._output, 'rb') as f:
-                    f.seek(-2, os.SEEK_END)
-                    while f.read(1) != b'\n':
-                        f.seek(-2, os.SEEK_CUR)
-                    last_tweet = f.readline().decode()
-                tweet_items = last_tweet.split(',')
+            if csv or self._output != 'adb':
+                # Last Tweet in the output file
+                last_tweet = filesink.last_row(self._output)
+                if not last_tweet:
+                    print('No last tweet, starting file from scratch.')
+                    return
                 # Convert to a datetime object
-                last_date = time.strptime(tweet_items[0], '%a %b %d %H:%M:%S +0000 %Y')
+                last_date = time.strptime(last_tweet[writer.TWEET_DATE], '%a %b %d %H:%M:%S +0000 %Y')
             elif adb:
-                cursor = con.cursor()        
-                sql = 'select tweet_date from {}'.format(self._table)
-                result = cursor.execute(sql)
-                try:
-                    last_date = next(iter(result))[0]
-                except Exception:
+                if not checkpoints.created:
+                    checkpoints.create()
+                marks = checkpoints.get(self._table)
+                if not marks:
+                    # Table written before checkpoints existed
+                    checkpoints.backfill(self._table)
+                    marks = checkpoints.get(self._table)
+                if not marks:
                     print('No last tweet, starting table from scratch.')
                     return
+                since_ids = checkpoints.since_ids(self._table, self._groups)
+                last_date = min(max_date for max_id, max_date in marks.values())
                 
             print("Starting fetch from:", last_date)
 
-        tweets = []
-        MAX_ATTEMPTS = 20
-        COUNT_OF_TWEETS_TO_BE_FETCHED = 5000000000000  
-        for i in range(0,MAX_ATTEMPTS):
-            if(COUNT_OF_TWEETS_TO_BE_FETCHED < len(tweets)):
-                break # we got 500 tweets... !!
-
-            #----------------------------------------------------------------#
-            # STEP 1: Query Twitter
-            # STEP 2: Save the returned tweets
-            # STEP 3: Get the next max_id
-            #----------------------------------------------------------------#
-
-            # STEP 1: Query Twitter
-            results = []
-            if(i == 0):
-                # Query twitter for data.
-                for term in terms:
-                    results.append(api.search(q=term,count='100'))
-            else:
-                # After the first call we should have max_id from result of previous call. 
-                # Pass it in query.
-                for term in terms:
-                    results.append(api.search(q=term,include_entities='true',max_id=next_max_id))
-
-            # STEP 2: Save the returned tweets
-            for result in results:
-                for status in result['statuses']:
-                    if status.get('lang', None) == 'en':
-                        # Extract tweet and append to file
-                        tweet = Tweet(status)
-                        # Note Streamer uses self.groups, not _groups. 
-                        # TODO: Fix consistency
-                        tweet.find_topic(self._groups)
-                        if tweet.keyword:
-                            date = time.strptime(tweet.tweet_date, '%a %b %d %H:%M:%S +0000 %Y')
-                            date = datetime.datetime.fromtimestamp(time.mktime(date))
-                            if type(last_date) is not str and type(last_date) is not datetime.datetime:
-                                time_last = time.mktime(last_date)
-                                last_date = datetime.datetime.fromtimestamp(time_last)
-                            print(date, '>', last_date, '=', date > last_date)
-                            if cont == False or date > last_date:
-                                tweet.save_to_adb(self._table)
-                        
-                        else:
-                            with open('errors.txt', 'a') as f:
-                                error_time = datetime.datetime.now()
-                                pp = pprint.PrettyPrinter(indent=2, stream=f)
-                                f.write('-'*7 + 'Fetch' + '-'*7)
-                                f.write(str(error_time) + ': Tweet filed under "misc":')
-                                f.write('-'*10 + "Data" + '-'*10 + '\n')
-                                pp.pprint(tweet.raw)
-                                f.write("-"*10 + "Summary" + "-"*10 + '\n')
-                                pp.pprint(tweet.summarize(tweet.raw))
-                                f.write('-'*10 + 'Groups' + '-'*10 + '\n')
-                                pp.pprint(self._groups)
-                                f.write('-'*20)
-                                print(str(error_time) + ": Misc logged\n") 
-
-            # STEP 3: Get the next max_id
-            try:
-                # Parse the data returned to get max_id to be passed in consequent call.
-                next_results_url_params = result['search_metadata']['next_results']
-                next_max_id = next_results_url_params.split('max_id=')[1].split('&')[0]
-            except:
-                # No more next pages
-                 break
+        # Each term pages with its own cursor, a few terms at a time,
+        # within the search rate limit
+        fetcher = scheduler.FetchScheduler(api.search, terms, since_ids=since_ids,
+                                           workers=3, max_pages=20)
+        calls = fetcher.run(lambda term, result: self.save_results([result], cont, last_date, term))
+        print("Fetched", sum(cursor.pages for cursor in fetcher.cursors), "pages in",
+              calls, "requests")
+        print("Skipped {duplicates} duplicate tweets of {checked}".format(**self._deduper.stats))
+
+        close_writers()
+
+    '''
+    Saves the statuses of search results: a list of api.search responses.
+    With cont, only tweets newer than last_date are saved.
+    term is the search term the results came from, for its checkpoint.
+    '''
+    def save_results(self, results, cont=False, last_date=None, term=None):
+        if cont and type(last_date) is time.struct_time:
+            last_date = datetime.datetime.fromtimestamp(time.mktime(last_date))
+        for result in results:
+            # Match topics first so the page is scored in one batch
+            matched = []
+            for status in result['statuses']:
+                if status.get('lang', None) == 'en':
+                    if self._deduper and self._deduper.contains(status['id']):
+                        continue
+                    # Extract tweet and append to file
+                    tweet = Tweet(status, score=False)
+                    tweet.find_topic(self._matcher)
+                    matched.append(tweet)
+            score_tweets([tweet for tweet in matched if tweet.keyword])
+
+            for tweet in matched:
+                if tweet.keyword:
+                    newer = True
+                    if cont:
+                        date = time.strptime(tweet.tweet_date, '%a %b %d %H:%M:%S +0000 %Y')
+                        date = datetime.datetime.fromtimestamp(time.mktime(date))
+                        newer = date > last_date
+                        print(date, '>', last_date, '=', newer)
+                    if newer:
+                        tweet.save_to_adb(self._table, term)
+                        if self._freqs:
+                            nlp.update_freq_db(tweet, get_freq_writer())
+                
+                else:
+                    get_error_log(self._groups).log('fetch', tweet.raw)
+                # Only now is the tweet handled; a failed page is fetched again on resume
+                if self._deduper:
+                    self._deduper.add(tweet.id)
 
 
 '''
 Streamer takes api credentials, a "groups" dictionary, and an outfile
 Used by the Flock class.
+on_success only queues payloads; a pool of worker threads does the
+parsing, scoring and saving so the stream is read at full speed.
 '''
 class Streamer(TwythonStreamer):
  
-    def __init__(self, *creds, groups, output):
+    def __init__(self, *creds, groups, output, workers=4, queue_size=1000, put_timeout=0,
+                 freqs=True, recorder=None, deduper=None, batch_size=32, raw=False, shedder=None):
         self._start_time = datetime.datetime.now()
         self.last_tweet_time =  self._start_time
         self.total_tweets = 0
         self.total_difference = 0
+        self.avg_time_per_tweet = 0
         self.groups = groups
+        self.matcher = KeywordMatcher(groups)
         self.output = output
+        self.freqs = freqs
+        self.recorder = recorder # replay.Recorder for raw payloads
+        self.deduper = deduper # dedup.Deduper, skips statuses seen before
+        self.shedder = shedder # shedding.LoadShedder, cheaper scoring under load
         self._quiet = True
+        # Raw line mode: pre-filter lines before decoding them
+        self.raw = raw
+        self.line_filter = prefilter.LineFilter()
+        # Work queue
+        self.workers = workers
+        # Seconds on_success waits for room in a full queue: 0 drops at once so
+        # the stream is never stalled, None waits for as long as it takes (replay)
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size # Most tweets a worker takes off the queue at once
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_queue_depth = 0
+        self.dropped = 0
+        self.processed = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        metrics.gauge('queue_depth', lambda: self.queue_depth)
+        metrics.gauge('max_queue_depth', lambda: self.max_queue_depth)
+        metrics.gauge('dropped', lambda: self.dropped)
+        metrics.gauge('processed', lambda: self.processed)
+        if deduper:
+            metrics.gauge('dedup', lambda: deduper.stats)
+        if raw:
+            metrics.gauge('prefilter', lambda: self.line_filter.stats)
+        if shedder:
+            metrics.gauge('shed_level', lambda: shedder.level)
+            metrics.gauge('shedding', lambda: shedder.stats)
         super().__init__(*creds)  
 
     @property
@@ -318,8 +494,93 @@ class Streamer(TwythonStreamer):
     def duration(self):
         return datetime.datetime.now() - self._start_time
 
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='Streamer-%d' % len(self._threads),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Process everything already queued, then stop the workers
+    def stop_workers(self):
+        if self._threads:
+            print("Draining", self.queue_depth, "queued tweets")
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            # Take whatever else is waiting so it is scored in one call
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            datas = batch[:-1] if stop else batch
+            try:
+                if datas:
+                    self.process_batch(datas)
+            except Exception as e:
+                # process_batch handles bad tweets one by one, so nothing is retried here
+                print("Streamer worker error:", e)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    '''
+    Raw line mode replaces TwythonStreamer's read loop, which decodes
+    every line, with one that hands the undecoded lines to on_line.
+    '''
+    def _request(self, url, method='GET', params=None):
+        if not self.raw:
+            return super()._request(url, method, params)
+        self.connected = True
+        method = method.lower()
+        params, _ = _transparent_params(params)
+        args = {key: value for key, value in self.client_args.items()
+                if key in ('timeout', 'allow_redirects', 'verify')}
+        args['params' if method == 'get' else 'data'] = params
+        while self.connected:
+            try:
+                response = getattr(self.client, method)(url, **args)
+            except requests.exceptions.Timeout:
+                self.on_timeout()
+                continue
+            if response.status_code != 200:
+                self.on_error(response.status_code, response.content)
+                response.close()
+                time.sleep(self.retry_in)
+                continue
+            for line in response.iter_lines(self.chunk_size):
+                if not self.connected:
+                    break
+                if line:
+                    self.on_line(line)
+            response.close()
+
+    # Received an undecoded line
+    def on_line(self, line):
+        if self.recorder:
+            self.recorder.write_line(line)
+        data = self.line_filter.parse(line)
+        if data is not None:
+            self.on_success(data, recorded=True)
+
     # Received data
-    def on_success(self, data):
+    def on_success(self, data, recorded=False):
+        if self.recorder and not recorded:
+            self.recorder.write(data)
         # Only collect tweets in English
         lang = data.get('lang', None)
         if lang == 'en':
@@ -328,40 +589,119 @@ class Streamer(TwythonStreamer):
                 tweet_time = datetime.datetime.now()
                 tweet_time_difference = tweet_time - self.last_tweet_time
                 self.total_difference += tweet_time_difference.total_seconds()
-                avg_time_per_tweet = self.total_difference / self.total_tweets
+                self.avg_time_per_tweet = self.total_difference / self.total_tweets
                 self.last_tweet_time = tweet_time
-                
-                # Extract tweet and append to file
-                tweet = Tweet(data)
-                tweet.find_topic(self.groups)
-                if tweet.keyword:
-                    tweet.save_to_adb(self.output)
-                else:
-                    with open('errors.txt', 'a') as f:
-                        error_time = datetime.datetime.now()
-                        pp = pprint.PrettyPrinter(indent=2, stream=f)
-                        f.write('-'*20)
-                        f.write(str(error_time) + ': Tweet filed under "misc":')
-                        f.write('-'*10 + "Data" + '-'*10 + '\n')
-                        pp.pprint(tweet.raw)
-                        f.write("-"*10 + "Summary" + "-"*10 + '\n')
-                        pp.pprint(tweet.summarize(tweet.raw))
-                        f.write('-'*10 + 'Groups' + '-'*10 + '\n')
-                        pp.pprint(self.groups)
-                        f.write('-'*20)
-                        print(str(error_time) + ": Misc logged\n")
+
+                if self.deduper and self.deduper.contains(data['id']):
+                    return
+                shedder = self.shedder
+                if shedder:
+                    shedder.update(self.queue.qsize(), self.queue.maxsize, self.workers)
+                    if not shedder.keep(data):
                         return
-                
-                # Update stream status to console
-                if sys.stdout.isatty():
-                    rows, columns = os.popen('stty size', 'r').read().split()
-                    print('-' * int(columns))
-                # We are running headless
-                else:
-                    print('-' * 10)
-                
-                print(avg_time_per_tweet, "secs/tweet;", self.total_tweets, "total tweets")
-                print("Keyword:", tweet.keyword, "Tweet:", tweet.text)    
+                if not self._threads:
+                    self.start_workers()
+                try:
+                    if self.put_timeout == 0:
+                        self.queue.put_nowait(data)
+                    else:
+                        self.queue.put(data, timeout=self.put_timeout)
+                except queue.Full:
+                    # Workers are too far behind, drop rather than stall the stream
+                    self.dropped += 1
+                    return
+                # Recorded once queued, so a dropped tweet is kept if it is redelivered
+                if self.deduper:
+                    self.deduper.add(data['id'])
+                depth = self.queue.qsize()
+                if depth > self.max_queue_depth:
+                    self.max_queue_depth = depth
+
+    # A payload that could not be processed goes to the error log instead of being lost
+    def _failed(self, data, error):
+        print("Streamer worker error on tweet", data.get('id'), ":", error)
+        get_error_log(self.groups).log('failed', data)
+
+    # Scores the batch in one call, tweet by tweet if that fails; returns the scored pairs
+    def _score(self, matched, url, textblob):
+        try:
+            score_tweets([tweet for data, tweet in matched], url=url, textblob=textblob)
+            return matched
+        except Exception as e:
+            print("Streamer scoring error:", e, "- scoring", len(matched), "tweets one by one")
+        scored = []
+        for data, tweet in matched:
+            try:
+                score_tweets([tweet], url=url, textblob=textblob)
+                scored.append((data, tweet))
+            except Exception as e:
+                self._failed(data, e)
+        return scored
+
+    # Runs on a worker thread
+    # Every step that touches a payload (archive, misc log, save) runs once
+    # per payload, and a payload that fails is logged and skipped
+    def process_batch(self, datas):
+        # Extract tweets, score the ones with a topic and save them
+        start = time.perf_counter()
+        matched = []
+        for data in datas:
+            try:
+                tweet = Tweet(data, score=False)
+                tweet.find_topic(self.matcher)
+            except Exception as e:
+                self._failed(data, e)
+                continue
+            if tweet.keyword:
+                matched.append((data, tweet))
+            else:
+                get_error_log(self.groups).log('stream', tweet.raw)
+        shedder = self.shedder
+        # One level for the whole batch
+        level = shedder.level if shedder else 0
+        if matched:
+            matched = self._score(matched, url=level < 1, textblob=level < 2)
+            for data, tweet in matched:
+                try:
+                    tweet.save_to_adb(self.output)
+                    if self.freqs:
+                        nlp.update_freq_db(tweet, get_freq_writer())
+                except Exception as e:
+                    self._failed(data, e)
+        with self._lock:
+            self.processed += len(datas)
+        if shedder:
+            shedder.processed(len(datas), time.perf_counter() - start)
+            if matched:
+                shedder.record(level, len(matched))
+        if not matched:
+            return
+        try:
+            self.print_status([tweet for data, tweet in matched])
+        except Exception as e:
+            # The tweets are saved, so this must not reach _work's retry
+            print("Status error:", e)
+
+    # Update stream status to console
+    def print_status(self, tweets):
+        if sys.stdout.isatty():
+            rows, columns = os.popen('stty size', 'r').read().split()
+            print('-' * int(columns))
+        # We are running headless
+        else:
+            print('-' * 10)
+        
+        print(self.avg_time_per_tweet, "secs/tweet;", self.total_tweets, "total tweets")
+        print("Queue:", self.queue_depth, "waiting,", self.max_queue_depth, "max,",
+              self.dropped, "dropped,", self.processed, "processed")
+        cache = nlp.get_cache()
+        if cache is not None:
+            print("Sentiment cache: {hits} hits, {misses} misses, "
+                  "{hit_ratio:.1%} hit ratio".format(**cache.stats))
+        if self.shedder:
+            print("Shedding: {level} (load {load}), {sampled_out} retweets sampled out".format(**self.shedder.stats))
+        for tweet in tweets:
+            print("Keyword:", tweet.keyword, "Tweet:", tweet.text)    
     
     # Problem with the API
     def on_error(self, status_code, data):
@@ -375,19 +715,71 @@ Not sure where to encapsulating all
 the NLP functions to allow for News
 and Tweets to share them.
 
-Requires a connection object, "con".
+Uses a session from the shared pool.
 '''
 def create_freq_db(name):
     # View all tables
-    cursor = con.cursor()
-    tables = cursor.execute("SELECT table_name from user_tables")
-    tables = [table[0] for table in tables]
-    if name not in tables:
-        sql = '''create table {}
-                (TWEET_DATE DATE,
-                 TOKEN VARCHAR(280),
-                 COUNT NUMBER(38))'''.format(name)
-        cursor.execute(sql)
+    with pool.connection() as con:
+        cursor = con.cursor()
+        tables = cursor.execute("SELECT table_name from user_tables")
+        tables = [table[0] for table in tables]
+        if name not in tables:
+            sql = '''create table {}
+                    (TWEET_DATE DATE,
+                     TOKEN VARCHAR(280),
+                     COUNT NUMBER(38))'''.format(name)
+            cursor.execute(sql)
+
+'''
+Score a page of Tweets with a single nlp.get_sentiments call
+Tweets should be built with score=False
+'''
+def score_tweets(tweets, url=True, textblob=True):
+    results = nlp.get_sentiments([tweet.text for tweet in tweets], url, textblob)
+    for tweet, result in zip(tweets, results):
+        tweet.set_sentiment(result)
+    return tweets
+
+'''
+Payload shape dispatch for Tweet.getText and Tweet.getHashtags.
+Checks the same places in the same order as the old try/except
+chains, but looks each nested object up once.
+'''
+hashtag_re = re.compile(r'[#|@|\$]\S+')
+
+def extract_text(data):
+    retweeted = data.get('retweeted_status')
+    if retweeted:
+        # Extended text of original tweet, if RT'd (streamer, then REST API)
+        extended = retweeted.get('extended_tweet')
+        if extended and 'full_text' in extended:
+            return extended['full_text']
+        if 'full_text' in retweeted:
+            return retweeted['full_text']
+    # Extended text of an original tweet (streamer, then REST API)
+    extended = data.get('extended_tweet')
+    if extended and 'full_text' in extended:
+        return extended['full_text']
+    if 'full_text' in data:
+        return data['full_text']
+    # Basic text of original tweet if RT'd, then of an original tweet
+    if retweeted and 'text' in retweeted:
+        return retweeted['text']
+    return data.get('text', '')
+
+def extract_hashtags(data):
+    for key in ('quoted_status', 'retweeted_status'):
+        status = data.get(key)
+        if status:
+            extended = status.get('extended_tweet')
+            if extended and 'hashtags' in extended.get('entities', ()):
+                return extended['entities']['hashtags']
+            if key == 'retweeted_status' and 'hashtags' in status.get('entities', ()):
+                return status['entities']['hashtags']
+    entities = data.get('entities')
+    if entities and 'hashtags' in entities:
+        return entities['hashtags']
+    return []
 
 '''
 Methods for processing Tweets
@@ -395,83 +787,95 @@ Methods for processing Tweets
 class Tweet:
     # TODO: Make a tweet object have the attributes: summary, basic, and keyword
     # TODO: Add methods for printing out the atributes
+
+    # Fixed attributes keep per-tweet memory down; raw is released
+    # once a label is found (only the misc log needs it after that)
+    __slots__ = ('id', 'tweet_date', 'hashtags', 'text', 'twitter_user',
+                 'followers', 'following', 'favorites', 'retweets', 'user_loc',
+                 'keyword', 'negative', 'neutral', 'positive', 'raw')
     
-    def __init__(self, tweet):
+    def __init__(self, tweet, score=True):
         self.positive = 0
         self.neutral = 0
         self.negative = 0
+        self.keyword = None
         self.raw = tweet
-        self.process_tweet(tweet)
-        self.sanitize()
+        self.process_tweet(tweet, score)
+        # Only payloads that parse, so the archive holds no half-read tweets
+        if raw_archive is not None:
+            raw_archive.append(tweet)
         
 
     # Filter for data to save
-    def process_tweet(self, tweet):
+    # Pass score=False when the caller scores a whole page with score_tweets
+    def process_tweet(self, tweet, score=True):
         self.id = tweet['id']
         self.tweet_date = tweet['created_at']
+        start = time.perf_counter()
         self.getHashtags(tweet)
+        middle = time.perf_counter()
         self.getText(tweet)
-        sent_result = nlp.get_sentiment(self.text)
-        setattr(self, sent_result, 1)
-        self.twitter_user = self.deEmojify(tweet['user']['screen_name'])
-        self.followers = tweet['user']['followers_count']
-        self.following = tweet['user']['friends_count']
+        metrics.observe('getHashtags', middle - start)
+        metrics.observe('getText', time.perf_counter() - middle)
+        if score:
+            self.set_sentiment(nlp.get_sentiments([self.text])[0])
+        user = tweet['user']
+        self.twitter_user = self.deEmojify(user['screen_name'])
+        self.followers = user['followers_count']
+        self.following = user['friends_count']
         self.favorites = tweet['favorite_count']
         self.retweets = tweet['retweet_count']
-        location = tweet['user']['location']
+        location = user['location']
         self.user_loc = self.deEmojify(location) if location else "Earth"
 
 
-    # Save each tweet to csv file
-    def save_to_csv(self, outfile):
-        with open(outfile, 'a', newline='\n') as f:
-            if f.tell() == 0:
-                try: header = list(tweet.keys())
-                except Exception as e:
-                    print(tweet, "Error in save_to_csv")
-                writer = csv.DictWriter(f,fieldnames=header, quoting=csv.QUOTE_MINIMAL)
-                writer.writeheader()
-                try: writer.writerow(list(tweet.values())) # Occasionally causes an error for no keys
-                except Exception as e:
-                    print(tweet, "Error in save_to_csv")
+    # Flag the tweet with a result from nlp.get_sentiments
+    def set_sentiment(self, result):
+        self.positive = 0
+        self.neutral = 0
+        self.negative = 0
+        setattr(self, result['sentiment'], 1)
+
+    @property
+    def sentiment(self):
+        if self.positive:
+            return 'positive'
+        return 'negative' if self.negative else 'neutral'
 
-            else:
-                writer = csv.writer(f)
-                writer.writerow(list(tweet.values())) # Occasionally causes an error for no keys
+
+    # Save each tweet to a CSV/JSONL file through its shared FileWriter
+    def save_to_csv(self, outfile, term=None):
+        # Any name is a file here, output.txt included
+        file_outputs.add(outfile)
+        self.save_to_adb(outfile, term)
 
     # Format tweet for database
+    # Not run per tweet: values are passed as bind parameters, so
+    # quotes are safe, and text fields are already ASCII (deEmojify)
     def sanitize(self):
-        for attr in list(vars(self).keys()):
-            val = getattr(self, attr)
-            if val is str:
+        for attr in self.__slots__:
+            val = getattr(self, attr, None)
+            if isinstance(val, str):
                 setattr(self, attr, val.replace("'","").replace('"','').\
                                         encode('utf-8', errors='ignore').\
                                         decode('utf-8', errors='ignore'))
 
 
-    # Save each tweet to an ADB
-    def save_to_adb(self, table):
-        cursor = con.cursor()
-        sql = '''INSERT INTO {}
-                (ID,TWEET_DATE,HASHTAGS,TEXT,TWITTER_USER,
-                 FOLLOWERS,FOLLOWING,
-                 FAVORITE_COUNT,RETWEET_COUNT,USER_LOC,KEYWORD,
-                 negative,neutral,positive) 
-                 VALUES (:id, to_date(:tweet_date, \'Dy Mon dd hh24:mi:ss "+0000" yyyy\'), 
-                         :hashtags, :text, :twitter_user,
-                         :followers, :following, :favorites, 
-                         :retweets, :user_loc, :keyword, :negative, 
-                         :neutral, :positive)'''.format(table)
-        print(sql)
-        try:
-            tweet = {i:vars(self)[i] for i in vars(self) if i!='raw'}
-            cursor.execute(sql, tweet)
-            print("SQL inserted into ", table, "for Tweet with ID = ", self.id)
-            con.commit()
-        except Exception as e:
-            print("save_to_adb() error: ", e)
-            pp = pprint.PrettyPrinter(indent=2)
-            pp.pprint(vars(self))
+    # Bind parameters for an INSERT, in writer.COLUMNS order
+    def to_row(self):
+        return (self.id, self.tweet_date, self.hashtags, self.text, self.twitter_user,
+                self.followers, self.following, self.favorites, self.retweets,
+                self.user_loc, self.keyword, self.negative, self.neutral, self.positive)
+
+    # Queue each tweet for a batched insert into an ADB
+    # term is the search term that found it, None from the stream
+    def save_to_adb(self, table, term=None):
+        start = time.perf_counter()
+        table_writer = get_writer(table)
+        table_writer.add(self.to_row(), term)
+        get_aggregates(memory=isinstance(table_writer, filesink.FileWriter)).add(
+            self.keyword, self.sentiment, self.tweet_date)
+        metrics.observe('save_to_adb', time.perf_counter() - start)
 
     '''
     Used for sanitizing input for ADW
@@ -487,32 +891,12 @@ class Tweet:
     Inspired by: colditzjb @ https://github.com/tweepy/tweepy/issues/878
     '''
     def getText(self, data):       
-        # Try for extended text of original tweet, if RT'd (streamer)
-        try: text = data['retweeted_status']['extended_tweet']['full_text']
-        except: 
-            # Try for extended text of an original tweet, if RT'd (REST API)
-            try: text = data['retweeted_status']['full_text']
-            except:
-                # Try for extended text of an original tweet (streamer)
-                try: text = data['extended_tweet']['full_text']
-                except:
-                    # Try for extended text of an original tweet (REST API)
-                    try: text = data['full_text']
-                    except:
-                        # Try for basic text of original tweet if RT'd 
-                        try: text = data['retweeted_status']['text']
-                        except:
-                            # Try for basic text of an original tweet
-                            try: text = data['text']
-                            except: 
-                                # Nothing left to check for
-                                text = ''
+        text = extract_text(data)
         
         text = self.deEmojify(text).lower().replace('\n', ' ')
         
         # strip out hashtags for language processing
-        text = re.sub(r'[#|@|\$]\S+', '', text)
-        text.strip()
+        text = hashtag_re.sub('', text)
         
         self.text = text
         return text
@@ -523,27 +907,7 @@ class Tweet:
     Inspired by: colditzjk @ https://github.com/tweepy/tweepy/issues/878
     '''
     def getHashtags(self, data):            
-        try: text = data['quoted_status']['extended_tweet']['entities']['hashtags']
-        except:
-            # Try for extended text of original tweet, if RT'd (streamer)
-            try: text = data['retweeted_status']['extended_tweet']['entities']['hashtags']
-            except: 
-                # Try for extended text of an original tweet, if RT'd (REST API)
-                try: text = data['retweeted_status']['entities']['hashtags']
-                except:
-                    # Try for basic text of original tweet if RT'd 
-                    try: text = data['retweeted_status']['entities']['hashtags']
-                    except:
-                        # Try f or basic text of an original tweet
-                        try: text = data['entities']['hashtags']
-                        except:
-                            # Nothing left to check for
-                            text = ''
-
-        hashtags = []
-        for entity in text:
-            hashtags.append(entity["text"].lower())
-        self.hashtags = str(hashtags)
+        self.hashtags = str([entity["text"].lower() for entity in extract_hashtags(data)])
     
     
     '''
@@ -590,45 +954,19 @@ class Tweet:
 
 
     '''
-    Given a summarized Tweet (searchable text)
-    This method determines the search term
-    used to find this tweet.
+    Determines the label of the search term used to find this tweet.
+    topics is a KeywordMatcher compiled from the groups dict, or the
+    groups dict itself (compiled on every call, so prefer a matcher).
     Note: We can use this to "tally" the occurences of each term
-    By changing to tweet[topic][keyword] = 1
     '''
     def find_topic(self, topics):
-        tweet = self.summarize(self.raw)
-        found = list() 
-        for topic, keywords in topics.items():
-            found = self.find_keyword(tweet, keywords, found)
-        best_keyword = max(found, key=len) if found else None
-        if best_keyword:
-            for key, value in topics.items():
-                if best_keyword in value:
-                    self.keyword = key
-        else:
-            self.keyword = None
-   
-    '''
-    Helper method for find_topic
-    Need to fix this to find the longest keyword
-    '''
-    def find_keyword(self, val, keywords, found):
-        if type(val) is str: 
-            for keyword in keywords:
-                if self.find_string(keyword, val):
-                    # All parts of keyword found
-                    found.append(keyword)
-        else:
-            for key, value in val.items():
-                self.find_keyword(value, keywords, found)
-        return found
-
-    def find_string(self, string, text):
-        for word in string.split():
-            if word not in text:
-                return False
-        return True
+        start = time.perf_counter()
+        if not isinstance(topics, KeywordMatcher):
+            topics = KeywordMatcher(topics)
+        self.keyword = topics.match(self.raw)
+        if self.keyword:
+            self.raw = None
+        metrics.observe('find_topic', time.perf_counter() - start)
 
 if __name__ == '__main__':           
     # Save filters and output file  
@@ -0,0 +1,228 @@
+'''
+Batch VADER compound scores with NumPy.
+SentimentIntensityAnalyzer walks each text word by word with dict
+lookups. LexiconEngine splits a batch into words the way VADER does,
+maps them to integer ids in precomputed lexicon arrays (valence,
+booster scalar, negation and the handful of words the rules look for),
+and applies the rules to every word of the batch at once: the
+"no" rules, ALL CAPS emphasis, boosters and negation over the three
+previous words, "least", then per-text sums, punctuation emphasis and
+the compound normalization.
+
+Texts containing one of VADER's multi-word idioms or boosters
+("kind of", "the bomb", ...) are rare and are handed to the reference
+analyzer, as are the order quirks of its "but" rule, so compound scores
+match polarity_scores to its 4 decimal places.
+
+    python3 lexicon.py [corpus.jsonl]    parity check and benchmark
+'''
+import string # VADER's punctuation stripping
+import sys # Benchmark arguments
+import time # Benchmark timing
+import numpy as np
+from vaderSentiment.vaderSentiment import (SentimentIntensityAnalyzer, BOOSTER_DICT, NEGATE,
+                                           SPECIAL_CASES, C_INCR, N_SCALAR)
+
+# Ids of words outside every table
+OTHER, OTHER_NT = 0, 1
+# Words the rules compare against
+SPECIAL_WORDS = ('no', 'or', 'nor', 'never', 'so', 'this', 'without', 'doubt', 'least', 'at', 'very', 'but')
+# Multi-word entries; texts with one go to the reference analyzer
+PHRASES = tuple(phrase for phrase in list(SPECIAL_CASES) + list(BOOSTER_DICT) if ' ' in phrase)
+
+
+class LexiconEngine(object):
+    '''
+    compound(texts) returns an array of VADER compound scores.
+    '''
+
+    def __init__(self, analyzer=None):
+        self.analyzer = analyzer or SentimentIntensityAnalyzer()
+        self.emojis = self.analyzer.emojis
+        self.fallbacks = 0
+        lexicon = self.analyzer.lexicon
+        words = ['', "n't"] + sorted(set(lexicon) | set(BOOSTER_DICT) | set(NEGATE) | set(SPECIAL_WORDS))
+        self.ids = {word: index for index, word in enumerate(words)}
+        self.ids.pop('', None)
+        self.ids.pop("n't", None)
+        self.valence = np.array([lexicon.get(word, 0.0) for word in words])
+        self.in_lexicon = np.array([word in lexicon for word in words])
+        self.booster = np.array([BOOSTER_DICT.get(word, 0.0) for word in words])
+        self.is_booster = np.array([word in BOOSTER_DICT for word in words])
+        self.negate = np.array([word in NEGATE or "n't" in word for word in words])
+        self.special = {word: self.ids[word] for word in SPECIAL_WORDS}
+
+    def _strip_emojis(self, text):
+        # Same as SentimentIntensityAnalyzer.polarity_scores
+        text_no_emoji = ''
+        prev_space = True
+        for character in text:
+            if character in self.emojis:
+                if not prev_space:
+                    text_no_emoji += ' '
+                text_no_emoji += self.emojis[character]
+                prev_space = False
+            else:
+                text_no_emoji += character
+                prev_space = character == ' '
+        return text_no_emoji
+
+    # VADER's words: split on whitespace, punctuation stripped unless that leaves 2 or fewer characters
+    def words(self, text):
+        if not self.emojis.keys().isdisjoint(text):
+            text = self._strip_emojis(text)
+        words = []
+        for word in text.split():
+            stripped = word.strip(string.punctuation)
+            words.append(word if len(stripped) <= 2 else stripped)
+        return words
+
+    def compound(self, texts):
+        ids, upper, text_index, positions = [], [], [], []
+        lengths, cap_diff, amplifiers, fallback, buts = [], [], [], [], []
+        lookup = self.ids.get
+        for number, text in enumerate(texts):
+            words = self.words(text)
+            lowered = [word.lower() for word in words]
+            joined = ' '.join(lowered)
+            fallback.append(any(phrase in joined for phrase in PHRASES))
+            buts.append('but' in lowered)
+            uppers = [word.isupper() for word in words]
+            capitals = sum(uppers)
+            cap_diff.append(0 < len(words) - capitals < len(words))
+            exclamations = min(text.count('!'), 4) * 0.292
+            questions = text.count('?')
+            amplifiers.append(exclamations + (0 if questions <= 1 else questions * 0.18 if questions <= 3 else 0.96))
+            lengths.append(len(words))
+            for position, word in enumerate(lowered):
+                ids.append(lookup(word, OTHER_NT if "n't" in word else OTHER))
+                positions.append(position)
+            upper.extend(uppers)
+            text_index.extend([number] * len(words))
+
+        count = len(texts)
+        ids = np.asarray(ids, dtype=np.int64)
+        upper = np.asarray(upper, dtype=bool)
+        text_index = np.asarray(text_index, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        cap = np.asarray(cap_diff, dtype=bool)[text_index] if len(ids) else np.zeros(0, dtype=bool)
+        sentiments = self._sentiments(ids, upper, cap, positions, lengths[text_index] if len(ids) else lengths[:0])
+
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if count else lengths
+        totals = np.bincount(text_index, weights=sentiments, minlength=count) if len(ids) else np.zeros(count)
+        for number in range(count):
+            if buts[number] and not fallback[number]:
+                segment = sentiments[starts[number]:starts[number] + lengths[number]].tolist()
+                words = self.words(texts[number])
+                totals[number] = float(sum(SentimentIntensityAnalyzer._but_check(words, segment)))
+
+        amplifiers = np.asarray(amplifiers, dtype=np.float64)
+        totals = np.where(totals > 0, totals + amplifiers, np.where(totals < 0, totals - amplifiers, totals))
+        compounds = np.clip(totals / np.sqrt(totals * totals + 15), -1.0, 1.0)
+        compounds[lengths == 0] = 0.0
+        compounds = np.round(compounds, 4)
+        for number in np.flatnonzero(fallback):
+            compounds[number] = self.analyzer.polarity_scores(texts[number])['compound']
+        self.fallbacks += int(np.count_nonzero(fallback))
+        return compounds
+
+    def _sentiments(self, ids, upper, cap, positions, lengths):
+        special = self.special
+        in_lexicon = self.in_lexicon[ids]
+
+        # Word k places before each word, OTHER where there is none
+        def back(k, array=ids, fill=OTHER):
+            shifted = np.full_like(array, fill)
+            if k < len(array):
+                shifted[k:] = array[:len(array) - k]
+            return np.where(positions >= k, shifted, fill)
+
+        previous = [None] + [back(k) for k in (1, 2, 3)]
+        previous_upper = [None] + [back(k, upper, False) for k in (1, 2, 3)]
+        following = np.full_like(ids, OTHER)
+        following[:-1] = ids[1:]
+        following = np.where(positions < lengths - 1, following, OTHER)
+
+        base = self.valence[ids]
+        valence = base.copy()
+        # "no" before another lexicon word carries no sentiment itself
+        valence[(ids == special['no']) & self.in_lexicon[following]] = 0.0
+        after_no = (previous[1] == special['no']) | (previous[2] == special['no']) | \
+                   ((previous[3] == special['no']) & ((previous[1] == special['or']) | (previous[1] == special['nor'])))
+        valence = np.where(after_no, base * N_SCALAR, valence)
+        emphasis = upper & cap
+        valence = np.where(emphasis, np.where(valence > 0, valence + C_INCR, valence - C_INCR), valence)
+
+        for start in range(3):
+            word = previous[start + 1]
+            applies = in_lexicon & (positions > start) & ~self.in_lexicon[word]
+            scalar = np.where(self.is_booster[word], self.booster[word], 0.0)
+            scalar = np.where(valence < 0, -scalar, scalar)
+            boosted_caps = self.is_booster[word] & previous_upper[start + 1] & cap
+            scalar = np.where(boosted_caps, np.where(valence > 0, scalar + C_INCR, scalar - C_INCR), scalar)
+            scalar = scalar * (1.0, 0.95, 0.9)[start]
+            valence = np.where(applies, valence + scalar, valence)
+
+            negated = self.negate[word]
+            if start == 0:
+                factor = np.where(negated, N_SCALAR, 1.0)
+            elif start == 1:
+                never = (previous[2] == special['never']) & \
+                        ((previous[1] == special['so']) | (previous[1] == special['this']))
+                doubt = (previous[2] == special['without']) & (previous[1] == special['doubt'])
+                factor = np.where(never, 1.25, np.where(doubt, 1.0, np.where(negated, N_SCALAR, 1.0)))
+            else:
+                # VADER's "A and B or C": "so"/"this" right before always counts
+                never = ((previous[3] == special['never']) &
+                         ((previous[2] == special['so']) | (previous[2] == special['this']))) | \
+                        (previous[1] == special['so']) | (previous[1] == special['this'])
+                doubt = (previous[3] == special['without']) & \
+                        ((previous[2] == special['doubt']) | (previous[1] == special['doubt']))
+                factor = np.where(never, 1.25, np.where(doubt, 1.0, np.where(negated, N_SCALAR, 1.0)))
+            valence = np.where(applies, valence * factor, valence)
+
+        least = (previous[1] == special['least']) & ~self.in_lexicon[previous[1]]
+        not_at_least = (positions > 1) & (previous[2] != special['at']) & (previous[2] != special['very'])
+        valence = np.where(in_lexicon & least & ((positions == 1) | not_at_least), valence * N_SCALAR, valence)
+
+        # Boosters score 0 whether or not they are in the lexicon; other words only count from the lexicon
+        return np.where(in_lexicon & ~self.is_booster[ids], valence, 0.0)
+
+
+def bench_lexicon(path=None, repeat=20):
+    import nlp # Corpus loading
+    if path:
+        texts = nlp.load_corpus(path)
+    else:
+        texts = ["VADER is smart, handsome, and funny.", "VADER is VERY SMART, uber handsome, and FRIGGIN FUNNY!!!",
+                 "VADER is not smart, handsome, nor funny.", "At least it isn't a horrible book.",
+                 "The book was only kind of good.", "Today SUX!", "Today only kinda sux! But I'll get by, lol",
+                 "The plot was good, but the characters are uncompelling and the dialog is not great.",
+                 "Make sure you :) or :D today!", "Catch utf-8 emoji such as 💘 and 💋 and 😁", "Not bad at all",
+                 "Sentiment analysis has never been this good!", "Without a doubt, excellent idea.",
+                 "Roger Dodger is one of the least compelling variations on this theme.",
+                 "no love no hate, NO WAY this is GREAT??", "I don't think it's very good at all... not so bad"] * repeat
+    engine = LexiconEngine()
+    analyzer = engine.analyzer
+
+    start = time.perf_counter()
+    reference = np.array([analyzer.polarity_scores(text)['compound'] for text in texts])
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compounds = engine.compound(texts)
+    engine_time = time.perf_counter() - start
+
+    difference = np.abs(compounds - reference)
+    mismatches = np.flatnonzero(difference > 1e-4)
+    print("Parity: %d texts, max difference %.6f, %d over 1e-4, %d via the reference analyzer" %
+          (len(texts), difference.max() if len(texts) else 0.0, len(mismatches), engine.fallbacks))
+    for index in mismatches[:10]:
+        print("  %r: engine %.4f, reference %.4f" % (texts[index], compounds[index], reference[index]))
+    print("polarity_scores: %10.1f texts/sec" % (len(texts) / reference_time))
+    print("LexiconEngine:   %10.1f texts/sec" % (len(texts) / engine_time))
+    return len(mismatches) == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if bench_lexicon(sys.argv[1] if len(sys.argv) > 1 else None) else 1)
@@ -0,0 +1,192 @@
+'''
+Compiled keyword matcher for labelling tweets.
+A KeywordMatcher is built once from the query.txt groups. Every word of
+every keyword goes into one Aho-Corasick automaton, so each searchable
+field of a tweet is scanned once no matter how many keywords we track.
+
+Matching follows the original Tweet.find_topic rules:
+    - a keyword matches a field when each of its words is a substring of it
+    - the longest matching keyword wins, ties go to the first one found
+    - the label is the last group that lists the winning keyword
+
+Benchmark against the field-by-field scan:
+    python3 matcher.py [tweets]
+'''
+from collections import deque
+import random # Benchmark data
+import sys # For benchmark arguments
+import time # Benchmark timing
+
+# Fields Tweet.summarize keeps and the nested objects it descends into
+TEXT_FIELDS = ('text', 'full_text', 'screen_name', 'expanded_url', 'display_url', 'id_str')
+NESTED_FIELDS = ('retweeted_status', 'quoted_status', 'user', 'extended_tweet', 'entities')
+
+
+'''
+Yields the searchable strings of a tweet in the same order as the
+values of Tweet.summarize, without building the nested summary dict.
+'''
+def iter_fields(tweet):
+    for field, value in tweet.items():
+        if field in TEXT_FIELDS and value is not None:
+            if field == 'text' or field == 'full_text':
+                yield value.encode('ascii', 'ignore').decode('ascii').lower().replace('\n', ' ')
+            else:
+                yield value
+        elif field in NESTED_FIELDS:
+            if value:
+                yield from iter_fields(value)
+        elif field == 'urls':
+            # summarize keeps only the last link
+            if type(value) is list and len(value):
+                yield from iter_fields(value[-1])
+
+
+class Automaton(object):
+    '''
+    Aho-Corasick automaton over a set of words.
+    find(text) returns the set of words that occur anywhere in text.
+    '''
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for word in words:
+            state = 0
+            for char in word:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] = self._out[state] + (word,)
+
+        # Breadth first so each fail link points at an already finished state
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[nxt] = fail
+                self._out[nxt] = self._out[nxt] + self._out[fail]
+
+    def find(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class KeywordMatcher(object):
+    '''
+    Built from a groups dict: {"label": ["keyword", "key phrase", ...]}
+    match(tweet) takes the raw tweet dict and returns a label or None.
+    '''
+
+    def __init__(self, groups):
+        self.groups = groups
+        self._words = {} # keyword -> tuple of words
+        self._by_word = {} # word -> keywords containing it
+        self._order = {} # keyword -> [(group index, position), ...]
+        self._label = {} # keyword -> label of the last group listing it
+        self._wordless = [] # keywords with no words match every field
+        for group, (label, keywords) in enumerate(groups.items()):
+            for position, keyword in enumerate(keywords):
+                self._order.setdefault(keyword, []).append((group, position))
+                self._label[keyword] = label
+                if keyword in self._words:
+                    continue
+                words = tuple(keyword.split())
+                self._words[keyword] = words
+                if not words:
+                    self._wordless.append(keyword)
+                for word in words:
+                    self._by_word.setdefault(word, []).append(keyword)
+        self._automaton = Automaton(self._by_word)
+
+    def match(self, tweet):
+        first_field = {} # keyword -> index of the first field it matched
+        for index, text in enumerate(iter_fields(tweet)):
+            if index == 0:
+                for keyword in self._wordless:
+                    first_field[keyword] = 0
+            found = self._automaton.find(text)
+            for word in found:
+                for keyword in self._by_word[word]:
+                    if keyword not in first_field and \
+                            all(part in found for part in self._words[keyword]):
+                        first_field[keyword] = index
+        if not first_field:
+            return None
+
+        longest = max(len(keyword) for keyword in first_field)
+        best = min(((group, first_field[keyword], position), keyword)
+                   for keyword in first_field if len(keyword) == longest
+                   for group, position in self._order[keyword])[1]
+        return self._label[best]
+
+
+'''
+Reference implementation of the original per-topic, per-field scan
+'''
+def scan_match(groups, tweet):
+    fields = list(iter_fields(tweet))
+    found = []
+    for keywords in groups.values():
+        for text in fields:
+            for keyword in keywords:
+                if all(word in text for word in keyword.split()):
+                    found.append(keyword)
+    best_keyword = max(found, key=len) if found else None
+    label = None
+    if best_keyword:
+        for key, value in groups.items():
+            if best_keyword in value:
+                label = key
+    return label
+
+
+def bench_matcher(n=2000, sizes=(10, 100, 1000)):
+    rng = random.Random(0)
+    vocab = ['w%d' % i for i in range(5000)]
+    for size in sizes:
+        groups = {}
+        for i in range(size):
+            label = 'label%d' % (i // 5)
+            groups.setdefault(label, []).append(' '.join(rng.sample(vocab, rng.randint(1, 2))))
+        tweets = [{'id_str': str(i),
+                   'text': ' '.join(rng.sample(vocab, 20)),
+                   'user': {'screen_name': 'user%d' % i, 'id_str': str(i)}}
+                  for i in range(n)]
+
+        start = time.perf_counter()
+        matcher = KeywordMatcher(groups)
+        compiled = [matcher.match(tweet) for tweet in tweets]
+        compiled_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scanned = [scan_match(groups, tweet) for tweet in tweets]
+        scan_time = time.perf_counter() - start
+
+        assert compiled == scanned
+        print("%5d keywords: compiled %9.1f tweets/sec, scan %9.1f tweets/sec" %
+              (size, n / compiled_time, n / scan_time))
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    bench_matcher(int(argv[1]) if len(argv) > 1 else 2000)
@@ -0,0 +1,134 @@
+'''
+Low overhead latency histograms for the tweet pipeline.
+Stages call observe(name, seconds) with a perf_counter difference.
+Each observation is one bisect into fixed log-spaced buckets, so
+the timers can stay on in production.
+
+Snapshots (count, mean and p50/p95/p99 in ms per stage, plus gauges)
+are printed as JSON lines by start_reporter() and served as JSON by
+serve(port) at http://127.0.0.1:<port>/metrics
+'''
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json # Structured log lines and the metrics endpoint
+import threading # Reporter and server threads
+import time # Timestamps
+
+enabled = True
+
+# Bucket upper bounds in seconds: 1us to ~100s, 10% apart
+BOUNDS = []
+bound = 1e-6
+while bound < 100:
+    BOUNDS.append(bound)
+    bound *= 1.1
+BOUNDS.append(float('inf'))
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BOUNDS)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(BOUNDS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the pct-th observation
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = count * pct / 100
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return BOUNDS[index] if index < len(BOUNDS) - 1 else BOUNDS[-2]
+        return BOUNDS[-2]
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                'p50_ms': round(self.percentile(50) * 1000, 3),
+                'p95_ms': round(self.percentile(95) * 1000, 3),
+                'p99_ms': round(self.percentile(99) * 1000, 3)}
+
+
+histograms = {}
+gauges = {}
+_lock = threading.Lock()
+
+
+def histogram(name):
+    hist = histograms.get(name)
+    if hist is None:
+        with _lock:
+            hist = histograms.setdefault(name, Histogram())
+    return hist
+
+
+def observe(name, seconds):
+    if enabled:
+        histogram(name).observe(seconds)
+
+
+# fn is called at snapshot time, e.g. lambda: streamer.queue_depth
+def gauge(name, fn):
+    gauges[name] = fn
+
+
+def snapshot():
+    stages = {name: hist.summary() for name, hist in list(histograms.items())}
+    values = {}
+    for name, fn in list(gauges.items()):
+        try:
+            values[name] = fn()
+        except Exception as e:
+            values[name] = str(e)
+    return {'time': time.time(), 'stages': stages, 'gauges': values}
+
+
+def reset():
+    with _lock:
+        histograms.clear()
+
+
+def start_reporter(interval=60.0):
+    def report():
+        while True:
+            time.sleep(interval)
+            print('metrics ' + json.dumps(snapshot()))
+    thread = threading.Thread(target=report, name='MetricsReporter', daemon=True)
+    thread.start()
+    return thread
+
+
+def serve(port=9100, host='127.0.0.1'):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(snapshot()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
@@ -1,7 +1,19 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import datetime
+from functools import partial
+import json
+import multiprocessing
 import re
 import requests
+from requests.adapters import HTTPAdapter
+import sys
+import threading
+import time
 from textblob import TextBlob
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer 
+from cache import SentimentCache
+import metrics
 # ------------- Tokenize Text ---------------- 
 
 emoticons_str = r'''
@@ -15,9 +27,9 @@ regex_str = \
     [
         emoticons_str,
         r'<[&>]+>', # HTML tags
-        r'@(\w+)', # @mentions
-        r'\#(\w+)', # Hashtags
-        r'(http|https|ftp):\/\/[a-zA-Z0-9\\.\/]+', # URLs
+        r'@(?:\w+)', # @mentions
+        r'\#(?:\w+)', # Hashtags
+        r'(?:http|https|ftp):\/\/[a-zA-Z0-9\\.\/]+', # URLs
         r'(?:\d+,?)+(?:\.?\d+)?', # Numbers
         r"(?:[a-z][a-z'\-_]+[a-z])", # Contractions & compound adjectives (-, ')
         r'(?:[\w_]+)', # Other words
@@ -26,103 +38,588 @@ regex_str = \
 
 tokens_re = re.compile(r'('+'|'.join(regex_str)+')', re.VERBOSE | re.IGNORECASE)
 emoticon_re = re.compile(r'^'+emoticons_str+'$', re.VERBOSE | re.IGNORECASE)
+# Emoticons and everything else in separate groups, so one findall
+# both splits the text and says which tokens to keep in their case
+split_re = re.compile(r'('+emoticons_str+')|('+'|'.join(regex_str[1:])+')',
+                      re.VERBOSE | re.IGNORECASE)
 
 def tokenize(text):
     return tokens_re.findall(text)
 
 # Extract tokens from tweet text portions
 def preprocess(text, lowercase=False):
-    tokens = tokenize(text)
-    if lowercase:
-        tokens = [token if emoticon_re.search(token) else token.lower() for token in tokens]
-    return tokens
+    if not lowercase:
+        return tokenize(text)
+    return [emoticon or token.lower() for emoticon, token in split_re.findall(text)]
+
+# Tokenize any iterable of texts (list, generator, stream), one list per text
+def tokenize_batch(texts, lowercase=True):
+    findall = split_re.findall
+    for text in texts:
+        if lowercase:
+            yield [emoticon or token.lower() for emoticon, token in findall(text)]
+        else:
+            yield [emoticon or token for emoticon, token in findall(text)]
+
+
+# Day a tweet counts towards, from its created_at string
+def tweet_day(tweet_date):
+    date = datetime.datetime.strptime(tweet_date, '%a %b %d %H:%M:%S +0000 %Y')
+    return datetime.datetime(date.year, date.month, date.day)
+
+# Count a tweet's tokens in a writer.FreqWriter for the tweet_freqs table
+def update_freq_db(tweet, freqs):
+    freqs.add(tweet_day(tweet.tweet_date), preprocess(tweet.text, lowercase=True))
+
+
+# Texts of a recorded corpus: a JSONL file of tweet payloads
+# or a plain text file with one text per line
+def load_corpus(path):
+    texts = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                texts.append(line)
+                continue
+            text = data.get('extended_tweet', {}).get('full_text') or data.get('full_text') or data.get('text')
+            if text:
+                texts.append(text)
+    return texts
 
 
-def update_freq_db(tweet):
-    create_freq_db("tweet_freqs")
+def bench_tokenizer(path):
+    """Tokens/sec over a recorded corpus"""
+    texts = load_corpus(path)
+
+    start = time.perf_counter()
+    tokens = sum(len(tokens) for tokens in tokenize_batch(texts))
+    elapsed = time.perf_counter() - start
+    print("tokenize_batch: %d texts, %d tokens, %.1f tokens/sec" % (len(texts), tokens, tokens / elapsed))
+
+    start = time.perf_counter()
+    for text in texts:
+        [token if emoticon_re.search(token) else token.lower() for token in tokenize(text)]
+    elapsed = time.perf_counter() - start
+    print("two pass:       %.1f tokens/sec" % (tokens / elapsed))
 
 # --------------------------------------------
 
 # Sentiment Alg credit to Chris "shirosaidev" Park
 # https://github.com/shirosaidev/stocksight
-def get_sentiment_from_url(text):
-    sentimentURL = 'http://text-processing.com/api/sentiment/'
-    payload = {'text': text}
-
-    try:
-        post = requests.post(sentimentURL, data=payload)
-    except requests.exceptions.RequestException as re:
-        print("Exception: requests exception getting sentiment from url caused by %s" % re)
-        raise
-
-    # return None if we are getting throttled or other connection problem
-    if post.status_code != 200:
-        print("Can't get sentiment from url caused by %s %s" % (post.status_code, post.text))
-        return None
-
-    response = post.json()
-
-    # neg = response['probability']['neg']
-    # neutral = response['probability']['neutral']
-    # pos = response['probability']['pos']
-    label = response['label']
-
-    # determine if sentiment is positive, negative, or neutral
-    if label == "neg":
-        sentiment = "negative"
-    elif label == "neutral":
-        sentiment = "neutral"
-    else:
-        sentiment = "positive"
+SENTIMENT_URL = 'http://text-processing.com/api/sentiment/'
 
-    return sentiment
+class SentimentClient(object):
+    """Pooled client for the text-processing sentiment endpoint
+    Keeps keep-alive connections in a requests.Session, bounds the number
+    of requests in flight with a thread pool and applies a timeout to
+    every request.
+    After max_failures consecutive errors or non-200 responses the
+    circuit opens and classify returns None (local-only scoring) until
+    cooldown seconds have passed, then one trial request is let through.
+    """
 
+    def __init__(self, url=SENTIMENT_URL, workers=8, timeout=2.0,
+                 max_failures=5, cooldown=30.0):
+        self.url = url
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
 
-def get_sentiment(text):
-    """Determine if sentiment is positive, negative, or neutral
-    algorithm to figure out if sentiment is positive, negative or neutral
-    uses sentiment polarity from TextBlob, VADER Sentiment and
-    sentiment from text-processing URL
-    could be made better :)
-    """
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    # (allowed, probe): once the cooldown has passed one caller probes
+    # the service (half-open) while the others keep scoring locally
+    def _allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True, False
+            if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+                return False, False
+            self._probing = True
+            return True, True
 
-    # pass text into sentiment url
-    sentiment_url = get_sentiment_from_url(text)
+    def _record(self, ok, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if probe or (self._failures >= self.max_failures and self._opened_at is None):
+                    print("Sentiment url circuit open for %ss" % self.cooldown)
+                    self._opened_at = time.monotonic()
+
+    def classify(self, text):
+        # Returns "negative", "neutral", "positive" or None
+        allowed, probe = self._allow()
+        if not allowed:
+            return None
+
+        start = time.perf_counter()
+        try:
+            post = self._session.post(self.url, data={'text': text}, timeout=self.timeout)
+        except requests.exceptions.RequestException as re:
+            print("Exception: requests exception getting sentiment from url caused by %s" % re)
+            self._record(False, probe)
+            return None
+        finally:
+            metrics.observe('sentiment_url', time.perf_counter() - start)
+
+        # return None if we are getting throttled or other connection problem
+        if post.status_code != 200:
+            print("Can't get sentiment from url caused by %s %s" % (post.status_code, post.text))
+            self._record(False, probe)
+            return None
+        self._record(True, probe)
+
+        label = post.json()['label']
+
+        # determine if sentiment is positive, negative, or neutral
+        if label == "neg":
+            sentiment = "negative"
+        elif label == "neutral":
+            sentiment = "neutral"
+        else:
+            sentiment = "positive"
 
-    # pass text into TextBlob
-    text_tb = TextBlob(text)
+        return sentiment
 
-    # pass text into VADER Sentiment
-    analyzer = SentimentIntensityAnalyzer()
-    text_vs = analyzer.polarity_scores(text)
+    def classify_many(self, texts):
+        # Requests run concurrently, results keep the order of texts
+        return list(self._pool.map(self.classify, texts))
 
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self._session.close()
+
+
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = SentimentClient()
+    return _client
+
+# Point the module at another client, e.g. one aimed at stubs.SentimentStub
+def set_client(client):
+    global _client
+    if _client is not None and _client is not client:
+        _client.close()
+    _client = client
+
+
+def get_sentiment_from_url(text):
+    return get_client().classify(text)
+
+
+# Analyzers are loaded once per process and shared by every call.
+# Building a SentimentIntensityAnalyzer reads the VADER lexicon from disk.
+_vader = None
+
+def get_vader():
+    global _vader
+    if _vader is None:
+        _vader = SentimentIntensityAnalyzer()
+    return _vader
+
+
+def decide_sentiment(polarity, compound, sentiment_url=None):
+    """Combine the TextBlob polarity, VADER compound score and the
+    text-processing URL label into a single sentiment
+    """
     if sentiment_url is None:
-        if text_tb.sentiment.polarity <= 0 and text_vs['compound'] <= -0.5:
+        if polarity <= 0 and compound <= -0.5:
             sentiment = "negative"  # very negative
-        elif text_tb.sentiment.polarity <= 0 and text_vs['compound'] <= -0.1:
+        elif polarity <= 0 and compound <= -0.1:
             sentiment = "negative"  # somewhat negative
-        elif text_tb.sentiment.polarity == 0 and text_vs['compound'] > -0.1 and text_vs['compound'] < 0.1:
+        elif polarity == 0 and compound > -0.1 and compound < 0.1:
             sentiment = "neutral"
-        elif text_tb.sentiment.polarity >= 0 and text_vs['compound'] >= 0.1:
+        elif polarity >= 0 and compound >= 0.1:
             sentiment = "positive"  # somewhat positive
-        elif text_tb.sentiment.polarity > 0 and text_vs['compound'] >= 0.1:
+        elif polarity > 0 and compound >= 0.1:
             sentiment = "positive"  # very positive
         else:
             sentiment = "neutral"
     else:
-        if text_tb.sentiment.polarity < 0 and text_vs['compound'] <= -0.1 and sentiment_url == "negative":
+        if polarity < 0 and compound <= -0.1 and sentiment_url == "negative":
             sentiment = "negative"  # very negative
-        elif text_tb.sentiment.polarity <= 0 and text_vs['compound'] < 0 and sentiment_url == "neutral":
+        elif polarity <= 0 and compound < 0 and sentiment_url == "neutral":
             sentiment = "negative"  # somewhat negative
-        elif text_tb.sentiment.polarity >= 0 and text_vs['compound'] > 0 and sentiment_url == "neutral":
+        elif polarity >= 0 and compound > 0 and sentiment_url == "neutral":
             sentiment = "positive"  # somewhat positive
-        elif text_tb.sentiment.polarity > 0 and text_vs['compound'] >= 0.1 and sentiment_url == "positive":
+        elif polarity > 0 and compound >= 0.1 and sentiment_url == "positive":
             sentiment = "positive"  # very positive
         else:
             sentiment = "neutral"
 
+    return sentiment
+
+
+_cache = SentimentCache()
+metrics.gauge('sentiment_cache', lambda: _cache.stats if _cache is not None else None)
+
+def get_cache():
+    return _cache
+
+# Swap the cache, e.g. SentimentCache(path='sentiment-cache.db') to persist
+# across restarts or None to disable caching
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+_engine = None
+
+# Batch VADER compounds with lexicon.LexiconEngine (NumPy) instead of per text
+def set_lexicon_engine(enabled=True):
+    global _engine
+    if enabled:
+        import lexicon # Needs NumPy
+        _engine = lexicon.LexiconEngine(get_vader())
+    else:
+        _engine = None
+
+
+# (polarity, compound) for each text, on this process
+# textblob=False leaves polarity None
+# (polarity, compound) per text; textblob=False or vader=False leaves that score None
+def local_scores(texts, textblob=True, vader=True):
+    if not vader:
+        compounds = [None] * len(texts)
+    elif _engine is not None:
+        start = time.perf_counter()
+        compounds = _engine.compound(texts).tolist()
+        metrics.observe('sentiment_vader_batch', time.perf_counter() - start)
+    else:
+        analyzer = get_vader()
+        compounds = []
+        for text in texts:
+            start = time.perf_counter()
+            compounds.append(analyzer.polarity_scores(text)['compound'])
+            metrics.observe('sentiment_vader', time.perf_counter() - start)
+    if not textblob:
+        return [(None, compound) for compound in compounds]
+    scores = []
+    for text, compound in zip(texts, compounds):
+        start = time.perf_counter()
+        polarity = TextBlob(text).sentiment.polarity
+        metrics.observe('sentiment_textblob', time.perf_counter() - start)
+        scores.append((polarity, compound))
+    return scores
+
+
+def _start_worker(engine):
+    get_vader()
+    if engine:
+        set_lexicon_engine()
+
+
+class ProcessScorer(object):
+    """Runs local_scores on a pool of worker processes
+    TextBlob and VADER are pure Python, so one process uses one core.
+    Each worker loads VADER (and the lexicon engine if it is on) once at
+    start-up; batches are split into chunks and the results come back in
+    order. If a worker dies the
+    pool is restarted and the batch retried once, then scored in-process.
+    """
+
+    def __init__(self, workers=4, chunk_size=64):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        # spawn: forking a process that runs stream and writer threads is unsafe
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_start_worker,
+                                   initargs=(_engine is not None,),
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _restart(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                print("NLP worker process died, restarting the pool")
+                broken.shutdown(wait=False)
+                self._executor = self._start()
+                self.restarts += 1
+
+    def scores(self, texts, vader=True):
+        chunks = [texts[i:i + self.chunk_size] for i in range(0, len(texts), self.chunk_size)]
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                scores = []
+                for chunk in executor.map(partial(local_scores, vader=vader), chunks):
+                    scores.extend(chunk)
+                return scores
+            except BrokenProcessPool:
+                self._restart(executor)
+        return local_scores(texts, vader=vader)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_scorer = None
+
+# Score on n worker processes, or in this process when n is 0
+def set_processes(n, chunk_size=64):
+    global _scorer
+    if _scorer is not None:
+        _scorer.close()
+    _scorer = ProcessScorer(n, chunk_size) if n else None
+
+
+# local_scores, on the worker processes when they are on and TextBlob runs
+def batch_scores(texts, textblob=True, vader=True):
+    if _scorer is None or not textblob:
+        return local_scores(texts, textblob, vader)
+    start = time.perf_counter()
+    scores = _scorer.scores(texts, vader)
+    metrics.observe('sentiment_processes', time.perf_counter() - start)
+    return scores
+
+
+# Waits on the URL calls of a batch while score_texts scores it locally
+_url_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='sentiment-url')
+
+# url=False leaves out the text-processing.com label,
+# textblob=False the TextBlob polarity (decided as if it were 0)
+def score_texts(texts, url=True, textblob=True):
+    if _cascade is not None and textblob:
+        return _cascade.score(texts, url)
+    # Network calls for the whole batch run in the background while the local scorers work
+    pending = _url_pool.submit(get_client().classify_many, texts) if url else None
+    scores = batch_scores(texts, textblob)
+    url_sentiments = pending.result() if pending else [None] * len(texts)
+    results = []
+    for (polarity, compound), sentiment_url in zip(scores, url_sentiments):
+        decided = decide_sentiment(0.0 if polarity is None else polarity, compound, sentiment_url)
+        results.append({'sentiment': decided,
+                        'polarity': polarity,
+                        'compound': compound,
+                        'url': sentiment_url})
+    return results
+
+
+class Cascade(object):
+    """Cheapest scorer first, the next one only when the answer is unclear
+        - VADER alone decides when the compound is at least strong either way
+        - otherwise TextBlob is run; if both lean the same way (compound
+          beyond band, polarity beyond polarity_band, or both inside)
+          that label is used
+        - only when they disagree is the text-processing URL called and
+          the usual decide_sentiment rules applied
+    Results have the score_texts keys plus 'stage' (1, 2 or 3 scorers
+    needed; at 3 'url' is None if the call failed or url was off);
+    skipped scores are None. VADER runs on the lexicon engine and
+    TextBlob on the worker processes when those are on, as in score_texts.
+    """
+
+    def __init__(self, strong=0.5, band=0.1, polarity_band=0.05):
+        self.strong = strong
+        self.band = band
+        self.polarity_band = polarity_band
+        self.texts = 0
+        self.textblob_calls = 0
+        self.url_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        texts = self.texts or 1
+        return {'texts': self.texts, 'textblob_calls': self.textblob_calls, 'url_calls': self.url_calls,
+                'textblob_saved': 1 - self.textblob_calls / texts, 'url_saved': 1 - self.url_calls / texts}
+
+    def lean(self, score, band):
+        if score <= -band:
+            return "negative"
+        return "positive" if score >= band else "neutral"
+
+    def score(self, texts, url=True):
+        results = []
+        unclear = []
+        for polarity, compound in local_scores(texts, textblob=False):
+            result = {'sentiment': None, 'polarity': None, 'compound': compound, 'url': None, 'stage': 1}
+            if abs(compound) >= self.strong:
+                result['sentiment'] = "negative" if compound < 0 else "positive"
+            else:
+                unclear.append(len(results))
+            results.append(result)
+
+        disputed = []
+        # TextBlob only: the compound is already known
+        scores = batch_scores([texts[index] for index in unclear], vader=False) if unclear else []
+        for index, (polarity, compound) in zip(unclear, scores):
+            result = results[index]
+            result['polarity'] = polarity
+            result['stage'] = 2
+            vader = self.lean(result['compound'], self.band)
+            if vader == self.lean(result['polarity'], self.polarity_band):
+                result['sentiment'] = vader
+            else:
+                disputed.append(index)
+
+        labels = get_client().classify_many([texts[index] for index in disputed]) if url and disputed else []
+        for position, index in enumerate(disputed):
+            result = results[index]
+            result['stage'] = 3
+            if labels:
+                result['url'] = labels[position]
+            result['sentiment'] = decide_sentiment(result['polarity'], result['compound'], result['url'])
+
+        with self._lock:
+            self.texts += len(texts)
+            self.textblob_calls += len(unclear)
+            self.url_calls += len(labels)
+        return results
+
+
+_cascade = None
+
+# Score through cascade (a Cascade) instead of running every scorer, None to stop
+def set_cascade(cascade):
+    global _cascade
+    _cascade = cascade
+
+
+# A result with every label it needed: the URL's, or a cascade that settled without it
+def cacheable(result):
+    return result['url'] is not None or result.get('stage', 3) < 3
+
+
+def get_sentiments(texts, url=True, textblob=True):
+    """Score a batch of texts in one pass
+    Returns one dict per text with the final 'sentiment' label and the
+    raw scores it was decided from: 'polarity' (TextBlob),
+    'compound' (VADER) and 'url' (text-processing label or None)
+    Results are served from the sentiment cache where possible; results
+    scored without the URL label (load shedding, circuit open, failed
+    request) or without TextBlob are not cached
+    """
+    cache = _cache
+    if cache is None:
+        return score_texts(texts, url, textblob)
+
+    results = [cache.get(text) for text in texts]
+    missing = {}
+    for text, result in zip(texts, results):
+        if result is None:
+            missing.setdefault(text, None)
+    if missing:
+        scored = score_texts(list(missing), url, textblob)
+        if url and textblob:
+            complete = [(text, result) for text, result in zip(missing, scored) if cacheable(result)]
+            if complete:
+                cache.put_many([text for text, result in complete], [result for text, result in complete])
+        missing = dict(zip(missing, scored))
+        results = [missing[text] if result is None else result
+                   for text, result in zip(texts, results)]
+    return results
+
+
+def get_sentiment(text):
+    """Determine if sentiment is positive, negative, or neutral
+    algorithm to figure out if sentiment is positive, negative or neutral
+    uses sentiment polarity from TextBlob, VADER Sentiment and
+    sentiment from text-processing URL
+    could be made better :)
+    """
+    result = get_sentiments([text])[0]
+
     # output sentiment
-    print("Sentiment (url): " + str(sentiment_url))
-    print("Sentiment (algorithm): " + str(sentiment))
+    print("Sentiment (url): " + str(result['url']))
+    print("Sentiment (algorithm): " + str(result['sentiment']))
 
-    return sentiment
+    return result['sentiment']
+
+
+def bench_processes(path, counts=(1, 2, 4, 8)):
+    """Local scoring texts/sec with 1/2/4/8 worker processes"""
+    texts = load_corpus(path)
+    start = time.perf_counter()
+    local_scores(texts)
+    print("in-process:  %8.1f texts/sec" % (len(texts) / (time.perf_counter() - start)))
+    for count in counts:
+        scorer = ProcessScorer(count)
+        scorer.scores(texts[:count]) # wait for the workers to load VADER
+        start = time.perf_counter()
+        scorer.scores(texts)
+        elapsed = time.perf_counter() - start
+        scorer.close()
+        print("%d processes: %8.1f texts/sec" % (count, len(texts) / elapsed))
+
+
+def cascade_report(path, cascade=None):
+    """Agreement of a Cascade with the full ensemble on a sample
+    path is JSONL with a 'text' and, if already labelled by the full
+    ensemble, its 'sentiment'; unlabelled texts are scored here
+    """
+    cascade = cascade or Cascade()
+    texts, labels = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                texts.append(data['text'])
+                labels.append(data.get('sentiment'))
+    unlabelled = [index for index, label in enumerate(labels) if label is None]
+    if unlabelled:
+        print("Scoring", len(unlabelled), "unlabelled texts with every scorer")
+        previous = _cascade
+        set_cascade(None)
+        try:
+            full = score_texts([texts[index] for index in unlabelled])
+        finally:
+            set_cascade(previous)
+        for index, result in zip(unlabelled, full):
+            labels[index] = result['sentiment']
+
+    results = cascade.score(texts)
+    agree = sum(result['sentiment'] == label for result, label in zip(results, labels))
+    print("Thresholds: strong %.2f, band %.2f, polarity band %.2f" %
+          (cascade.strong, cascade.band, cascade.polarity_band))
+    print("Agreement with the full ensemble: %d/%d (%.1f%%)" % (agree, len(texts), 100.0 * agree / len(texts)))
+    for stage in (1, 2, 3):
+        staged = [(result, label) for result, label in zip(results, labels) if result['stage'] == stage]
+        if staged:
+            matched = sum(result['sentiment'] == label for result, label in staged)
+            print("  decided with %d scorer(s): %6d texts, %.1f%% agree" %
+                  (stage, len(staged), 100.0 * matched / len(staged)))
+    stats = cascade.stats
+    print("Calls saved: TextBlob %.1f%%, text-processing URL %.1f%%" %
+          (100 * stats['textblob_saved'], 100 * stats['url_saved']))
+    confusion = {}
+    for result, label in zip(results, labels):
+        key = (label, result['sentiment'])
+        confusion[key] = confusion.get(key, 0) + 1
+    print("Full ensemble -> cascade:", {'%s->%s' % key: count for key, count in sorted(confusion.items())})
+
+
+if __name__ == '__main__':
+    benches = {'tokens': bench_tokenizer, 'processes': bench_processes, 'cascade': cascade_report}
+    if len(sys.argv) != 3 or sys.argv[1] not in benches:
+        print('Usage:', sys.argv[0], 'tokens|processes|cascade', 'corpus.jsonl')
+        sys.exit(1)
+    benches[sys.argv[1]](sys.argv[2])
@@ -0,0 +1,127 @@
+'''
+Byte-level pre-filter for raw stream lines.
+TwythonStreamer json.loads every line before on_success throws away
+non-English statuses and control messages. classify() looks at the
+raw bytes first so only likely English statuses are decoded, with
+orjson or ujson when installed and the stdlib json otherwise.
+
+The lang check can let through a status whose retweet or quote is
+English while it is not; Streamer.on_success still checks the parsed
+lang, so the filter only ever skips lines that would be dropped anyway.
+
+    python3 prefilter.py stream.jsonl
+'''
+import json # Fallback parser
+import sys # Benchmark arguments
+import time # Benchmark timing
+
+try:
+    import orjson # Optional fast parser
+    loads = orjson.loads
+    parser = 'orjson'
+except ImportError:
+    try:
+        import ujson # Optional fast parser
+        loads = ujson.loads
+        parser = 'ujson'
+    except ImportError:
+        loads = json.loads
+        parser = 'json'
+
+STATUS, CONTROL, SKIP = 'status', 'control', 'skip'
+
+# Top-level keys of the stream's control messages
+CONTROL_KEYS = (b'delete', b'limit', b'disconnect', b'warning', b'scrub_geo',
+                b'status_withheld', b'user_withheld')
+CONTROL_PREFIXES = tuple(b'{"' + key + b'"' for key in CONTROL_KEYS)
+LANG_EN = (b'"lang":"en"', b'"lang": "en"')
+
+
+# STATUS for a line worth decoding, CONTROL for a control message, else SKIP
+def classify(line):
+    line = line.lstrip()
+    if line.startswith(CONTROL_PREFIXES):
+        return CONTROL
+    if LANG_EN[0] in line or LANG_EN[1] in line:
+        return STATUS
+    return SKIP
+
+
+# Name of a control message's type, without decoding it
+def control_type(line):
+    line = line.lstrip()
+    return line[2:line.index(b'"', 2)].decode()
+
+
+class LineFilter(object):
+    '''
+    Counts what happens to each raw line.
+    parse(line) returns the decoded status, or None if it was filtered out.
+    '''
+
+    def __init__(self):
+        self.lines = 0
+        self.skipped = 0
+        self.controls = {}
+        self.parsed = 0
+        self.errors = 0
+
+    @property
+    def stats(self):
+        return {'lines': self.lines, 'skipped': self.skipped, 'controls': dict(self.controls),
+                'parsed': self.parsed, 'errors': self.errors, 'parser': parser}
+
+    def parse(self, line):
+        self.lines += 1
+        kind = classify(line)
+        if kind == SKIP:
+            self.skipped += 1
+            return None
+        if kind == CONTROL:
+            name = control_type(line)
+            self.controls[name] = self.controls.get(name, 0) + 1
+            if name in ('disconnect', 'warning'):
+                print("Stream", name + ":", line.decode('utf-8', 'replace'))
+            return None
+        try:
+            data = loads(line)
+        except ValueError:
+            self.errors += 1
+            return None
+        self.parsed += 1
+        return data
+
+
+def bench_prefilter(path):
+    """Lines/sec of full decoding against the pre-filter on a recorded stream"""
+    with open(path, 'rb') as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    start = time.perf_counter()
+    full = 0
+    for line in lines:
+        data = json.loads(line)
+        if data.get('lang', None) == 'en':
+            full += 1
+    elapsed = time.perf_counter() - start
+    print("json.loads every line: %10.1f lines/sec, %d English" % (len(lines) / elapsed, full))
+
+    line_filter = LineFilter()
+    start = time.perf_counter()
+    kept = 0
+    for line in lines:
+        data = line_filter.parse(line)
+        if data is not None and data.get('lang', None) == 'en':
+            kept += 1
+    elapsed = time.perf_counter() - start
+    print("pre-filter + %-8s %10.1f lines/sec, %d English" % (parser + ':', len(lines) / elapsed, kept))
+    print(line_filter.stats)
+    if kept != full:
+        print("Mismatch:", full - kept, "English statuses filtered out")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage:', sys.argv[0], 'stream.jsonl')
+        sys.exit(1)
+    bench_prefilter(sys.argv[1])
@@ -0,0 +1,244 @@
+'''
+Record and replay raw tweet payloads for end-to-end benchmarks.
+Recorder appends every payload Streamer.on_success receives to a JSONL
+file (Flock(..., record='stream.jsonl')). The replay driver feeds such a
+file through Streamer.on_success or Flock.save_results without Twitter
+or Oracle: sentiment goes to a stubs.SentimentStub and rows to a sqlite
+stand-in with the create_stream_db layout.
+
+    python3 replay.py stream.jsonl [--mode stream|fetch] [--rate recorded|max]
+                      [--workers 4] [--latency 0.0] [--query query.txt] [--memory]
+'''
+import argparse # Replay options
+import datetime # Recorded tweet times
+import json # Payloads are stored one per line
+import os # Silencing pipeline output
+import resource # Peak RSS
+import sqlite3 # Stand-in sink
+import sys # Silencing pipeline output
+import threading # Recorder is shared by stream threads
+import time # Pacing and timing
+
+
+class Recorder(object):
+    '''
+    Appends payloads to a JSONL file through one buffered handle.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.recorded = 0
+        self._file = open(path, 'a', buffering=1 << 16)
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        line = json.dumps(data) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+
+    # A raw stream line, recorded before it is filtered or decoded
+    def write_line(self, line):
+        line = line.decode('utf-8', 'replace') + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_payloads(path):
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# Seconds since the epoch a payload was received, None if unknown
+def payload_time(data):
+    if 'timestamp_ms' in data:
+        return int(data['timestamp_ms']) / 1000
+    if 'created_at' in data:
+        date = datetime.datetime.strptime(data['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
+        return date.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return None
+
+
+# Yields payloads, sleeping between them at the recorded rate if paced
+def paced(payloads, pace):
+    first_recorded = first_replayed = None
+    for data in payloads:
+        if pace:
+            recorded = payload_time(data)
+            if recorded is not None:
+                if first_recorded is None:
+                    first_recorded, first_replayed = recorded, time.perf_counter()
+                wait = (recorded - first_recorded) - (time.perf_counter() - first_replayed)
+                if wait > 0:
+                    time.sleep(wait)
+        yield data
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(mode, count, elapsed, latencies, sink):
+    sys.stdout = sys.__stdout__
+    print("Replayed %d tweets (%s) in %.2fs: %.1f tweets/sec" %
+          (count, mode, elapsed, count / elapsed if elapsed else 0.0))
+    print("Latency ms: p50 %.2f, p95 %.2f, p99 %.2f, max %.2f" %
+          tuple(percentile(latencies, pct) * 1000 for pct in (50, 95, 99, 100)))
+    # ru_maxrss is in kilobytes on Linux
+    print("Peak RSS: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print("Rows in sink:", sink.execute('select count(*) from tweets').fetchone()[0])
+
+
+'''
+Points flock's writers at a sqlite stand-in instead of the ADB pool
+'''
+def install_sink(flock, table='tweets'):
+    import aggregates
+    import writer
+    sink = sqlite3.connect(':memory:', check_same_thread=False)
+    writer.create_sqlite_stream_db(sink, table)
+    writer.create_sqlite_freq_db(sink, 'tweet_freqs')
+    flock.writers[table] = writer.BatchWriter(sink, table)
+    flock.freq_writers['tweet_freqs'] = writer.FreqWriter(sink, 'tweet_freqs')
+    flock.summaries[aggregates.TABLE] = aggregates.SentimentAggregates(sink)
+    return sink
+
+
+def replay_stream(path, groups, pace=False, workers=4):
+    import flock
+
+    class ReplayStreamer(flock.Streamer):
+        # Latency from on_success to the end of processing
+        def __init__(self, *args, **kwargs):
+            self.latencies = []
+            self._arrived = {}
+            super().__init__(*args, **kwargs)
+
+        def on_success(self, data):
+            self._arrived[id(data)] = time.perf_counter()
+            super().on_success(data)
+
+        def process_batch(self, datas):
+            super().process_batch(datas)
+            done = time.perf_counter()
+            for data in datas:
+                arrived = self._arrived.pop(id(data), None)
+                if arrived is not None:
+                    self.latencies.append(done - arrived)
+
+    sink = install_sink(flock)
+    # Never drop on a full queue, a replay measures the pipeline not the stream
+    streamer = ReplayStreamer('key', 'secret', 'token', 'token-secret', groups=groups,
+                              output='tweets', workers=workers, put_timeout=None)
+    streamer.quiet = True
+    start = time.perf_counter()
+    for data in paced(read_payloads(path), pace):
+        streamer.on_success(data)
+    streamer.stop_workers()
+    flock.close_writers()
+    elapsed = time.perf_counter() - start
+    report('stream', streamer.processed, elapsed, streamer.latencies, sink)
+
+
+def replay_fetch(path, groups, pace=False, page_size=100):
+    import flock
+
+    # Bypasses Flock.__init__, which prompts for a table and creates it in ADB
+    fetcher = flock.Flock.__new__(flock.Flock)
+    fetcher._groups = groups
+    fetcher._matcher = flock.KeywordMatcher(groups)
+    fetcher._table = 'tweets'
+    fetcher._freqs = True
+    fetcher._deduper = None
+
+    sink = install_sink(flock)
+    latencies = []
+    count = 0
+    page = []
+    start = time.perf_counter()
+
+    def save(page):
+        page_start = time.perf_counter()
+        fetcher.save_results([{'statuses': page}])
+        # Pages are processed as a unit, so latency is amortized per tweet
+        latencies.extend([(time.perf_counter() - page_start) / len(page)] * len(page))
+
+    for data in paced(read_payloads(path), pace):
+        if 'id' not in data:
+            continue
+        page.append(data)
+        count += 1
+        if len(page) == page_size:
+            save(page)
+            page = []
+    if page:
+        save(page)
+    flock.close_writers()
+    elapsed = time.perf_counter() - start
+    report('fetch', count, elapsed, latencies, sink)
+
+
+'''
+Bytes allocated per Tweet object built from a recording, with raw
+released the way the pipeline releases it for labelled tweets
+'''
+def measure_memory(path, groups):
+    import flock
+    import tracemalloc
+    matcher = flock.KeywordMatcher(groups)
+    payloads = [data for data in read_payloads(path) if 'id' in data and 'user' in data]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tweets = []
+    for data in payloads:
+        tweet = flock.Tweet(data, score=False)
+        tweet.find_topic(matcher)
+        tweets.append(tweet)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    sys.stdout = sys.__stdout__
+    print("%d tweets, %d labelled: %.0f bytes/tweet retained" %
+          (len(tweets), sum(1 for tweet in tweets if tweet.keyword),
+           allocated / len(tweets) if tweets else 0.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded tweets through the pipeline')
+    parser.add_argument('path', help='JSONL file written by Recorder')
+    parser.add_argument('--mode', choices=['stream', 'fetch'], default='stream')
+    parser.add_argument('--rate', choices=['recorded', 'max'], default='max')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stub sentiment endpoint waits per request')
+    parser.add_argument('--query', default='query.txt', help='groups to label tweets with')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure bytes per Tweet with tracemalloc instead of replaying')
+    args = parser.parse_args()
+
+    import nlp
+    import stubs
+    # The pipeline prints per tweet; keep the console for the report
+    sys.stdout = open(os.devnull, 'w')
+    with open(args.query, 'r') as f:
+        groups = json.load(f)
+    if args.memory:
+        measure_memory(args.path, groups)
+        sys.exit(0)
+    with stubs.SentimentStub(latency=args.latency) as stub:
+        nlp.set_client(nlp.SentimentClient(url=stub.url))
+        if args.mode == 'stream':
+            replay_stream(args.path, groups, args.rate == 'recorded', args.workers)
+        else:
+            replay_fetch(args.path, groups, args.rate == 'recorded')
@@ -0,0 +1,227 @@
+'''
+Re-score the sentiment flags of an existing tweet table in place.
+After a change to the rules in nlp, stored rows keep their old
+NEGATIVE/NEUTRAL/POSITIVE flags. The job splits the table into ID
+ranges of about chunk_size rows (one NTILE pass over an ID index),
+reads each range with a large fetch size, scores the TEXT on a worker
+pool and writes back only the rows whose flags changed, with batched
+UPDATEs and one commit per chunk.
+
+Re-scoring a row twice gives the same flags, so progress is a single
+high-water ID per table (every chunk at or below it is done) saved in
+rescore_progress; a rerun carries on from there.
+
+    python3 rescore.py TABLE [--chunk-size 10000] [--workers 4] [--processes 0]
+                       [--no-url] [--restart] [--sqlite tweets.db]
+'''
+import argparse # Job options
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+import sqlite3 # Stand-in database
+import threading # One sqlite connection shared by the workers
+import time # Rows/sec
+import db # Pooled connections to ADB
+import nlp # Sentiment rules
+
+PROGRESS_TABLE = 'rescore_progress'
+SENTIMENTS = ('negative', 'neutral', 'positive')
+
+
+class Rescorer(object):
+    '''
+    con is a db.ConnectionPool or a sqlite3 connection, as for BatchWriter.
+        - chunk_size: rows per ID range
+        - workers: chunks read, scored and written at the same time
+        - fetch_size: rows per round trip when reading a chunk
+        - update_size: rows per executemany UPDATE
+        - url: include the text-processing.com label, as the stream does
+    '''
+
+    def __init__(self, con, table, chunk_size=10000, workers=4, fetch_size=5000,
+                 update_size=1000, url=True):
+        self.con = con
+        self.table = table
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.fetch_size = fetch_size
+        self.update_size = update_size
+        self.url = url
+        self.sqlite = isinstance(con, sqlite3.Connection)
+        self.rows = 0
+        self.changed = 0
+        self._lock = threading.Lock()
+        # sqlite connections can't be used by two threads at once
+        self._sqlite_lock = threading.Lock()
+
+    def _connection(self):
+        if self.sqlite:
+            return nullcontext(self.con)
+        return self.con.connection()
+
+    def prepare(self):
+        index = '{}_id'.format(self.table)
+        with self._connection() as con:
+            cursor = con.cursor()
+            if self.sqlite:
+                cursor.execute('create index if not exists {} on {} (ID)'.format(index, self.table))
+                cursor.execute('''create table if not exists {}
+                                (TABLE_NAME TEXT PRIMARY KEY, LAST_ID INTEGER)'''.format(PROGRESS_TABLE))
+            else:
+                indexes = [row[0].lower() for row in cursor.execute("SELECT index_name from user_indexes")]
+                if index.lower() not in indexes:
+                    print("Indexing", self.table, "by ID")
+                    cursor.execute('create index {} on {} (ID)'.format(index, self.table))
+                tables = [row[0].lower() for row in cursor.execute("SELECT table_name from user_tables")]
+                if PROGRESS_TABLE not in tables:
+                    cursor.execute('''create table {}
+                                    (TABLE_NAME VARCHAR(128) PRIMARY KEY,
+                                     LAST_ID NUMBER(25))'''.format(PROGRESS_TABLE))
+            con.commit()
+
+    def last_id(self):
+        with self._connection() as con:
+            cursor = con.cursor()
+            cursor.execute('select LAST_ID from {} where TABLE_NAME = :table_name'.format(PROGRESS_TABLE),
+                           {'table_name': self.table})
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def save_progress(self, last_id):
+        if self.sqlite:
+            sql = '''INSERT INTO {} (TABLE_NAME, LAST_ID) VALUES (:table_name, :last_id)
+                     ON CONFLICT (TABLE_NAME) DO UPDATE SET LAST_ID = excluded.LAST_ID'''
+        else:
+            sql = '''MERGE INTO {} p
+                     USING (SELECT :table_name TABLE_NAME, :last_id LAST_ID FROM dual) s
+                     ON (p.TABLE_NAME = s.TABLE_NAME)
+                     WHEN MATCHED THEN UPDATE SET p.LAST_ID = s.LAST_ID
+                     WHEN NOT MATCHED THEN INSERT (TABLE_NAME, LAST_ID) VALUES (s.TABLE_NAME, s.LAST_ID)'''
+        with self._sqlite_lock if self.sqlite else nullcontext():
+            with self._connection() as con:
+                con.cursor().execute(sql.format(PROGRESS_TABLE), {'table_name': self.table, 'last_id': last_id})
+                con.commit()
+
+    def reset(self):
+        with self._connection() as con:
+            con.cursor().execute('delete from {} where TABLE_NAME = :table_name'.format(PROGRESS_TABLE),
+                                 {'table_name': self.table})
+            con.commit()
+
+    # [(first ID, last ID, rows)] of about chunk_size rows each, above after
+    def chunks(self, after=None):
+        where = 'where ID > :after' if after is not None else ''
+        binds = {'after': after} if after is not None else {}
+        with self._connection() as con:
+            cursor = con.cursor()
+            cursor.execute('select count(*) from {} {}'.format(self.table, where), binds)
+            count = cursor.fetchone()[0]
+            if not count:
+                return []
+            binds['tiles'] = -(-count // self.chunk_size)
+            cursor.execute('''select min(ID), max(ID), count(*)
+                              from (select ID, ntile(:tiles) over (order by ID) TILE from {} {})
+                              group by TILE order by 1'''.format(self.table, where), binds)
+            return [tuple(row) for row in cursor]
+
+    def _read(self, first, last):
+        with self._connection() as con:
+            cursor = con.cursor()
+            cursor.arraysize = self.fetch_size
+            cursor.execute('''select ID, TEXT, NEGATIVE, NEUTRAL, POSITIVE from {}
+                              where ID between :first and :last'''.format(self.table),
+                           {'first': first, 'last': last})
+            return cursor.fetchall()
+
+    def _write(self, updates):
+        placeholder = '?' if self.sqlite else ':{}'
+        binds = [placeholder.format(position) for position in range(1, 5)]
+        sql = 'UPDATE {} SET NEGATIVE = {}, NEUTRAL = {}, POSITIVE = {} WHERE ID = {}'.format(
+            self.table, *binds)
+        with self._connection() as con:
+            cursor = con.cursor()
+            for start in range(0, len(updates), self.update_size):
+                cursor.executemany(sql, updates[start:start + self.update_size])
+            con.commit()
+
+    def rescore_chunk(self, first, last):
+        with self._sqlite_lock if self.sqlite else nullcontext():
+            rows = self._read(first, last)
+        texts = [row[1] or '' for row in rows]
+        results = nlp.score_texts(texts, url=self.url) if texts else []
+        updates = []
+        for row, result in zip(rows, results):
+            flags = tuple(int(result['sentiment'] == sentiment) for sentiment in SENTIMENTS)
+            if flags != tuple(row[2:5]):
+                updates.append(flags + (row[0],))
+        if updates:
+            with self._sqlite_lock if self.sqlite else nullcontext():
+                self._write(updates)
+        with self._lock:
+            self.rows += len(rows)
+            self.changed += len(updates)
+        return len(rows)
+
+    def run(self, restart=False, report_every=10):
+        self.prepare()
+        if restart:
+            self.reset()
+        after = self.last_id()
+        if after is not None:
+            print("Resuming", self.table, "after ID", after)
+        chunks = self.chunks(after)
+        total = sum(chunk[2] for chunk in chunks)
+        print("Re-scoring", total, "rows of", self.table, "in", len(chunks), "chunks")
+        start = time.perf_counter()
+        done = [False] * len(chunks)
+        mark = 0 # chunks before this one are all done
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.rescore_chunk, first, last): number
+                       for number, (first, last, count) in enumerate(chunks)}
+            for finished, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception as e:
+                    # The mark stops before this chunk, so a rerun picks it up
+                    print("Chunk", chunks[futures[future]][:2], "failed:", e)
+                    continue
+                done[futures[future]] = True
+                if done[mark]:
+                    while mark < len(chunks) and done[mark]:
+                        mark += 1
+                    self.save_progress(chunks[mark - 1][1])
+                if finished % report_every == 0 or finished == len(chunks):
+                    elapsed = time.perf_counter() - start
+                    rate = self.rows / elapsed if elapsed else 0.0
+                    print("%d/%d chunks, %d rows, %d changed, %.1f rows/sec, %.0f secs left" %
+                          (finished, len(chunks), self.rows, self.changed, rate,
+                           (total - self.rows) / rate if rate else 0.0))
+        elapsed = time.perf_counter() - start
+        print("Re-scored", self.rows, "rows (%d changed) in %.1f secs, %.1f rows/sec" %
+              (self.changed, elapsed, self.rows / elapsed if elapsed else 0.0))
+        return self.rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-score the sentiment flags of a tweet table')
+    parser.add_argument('table')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--fetch-size', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=0,
+                        help='score TextBlob/VADER on this many processes')
+    parser.add_argument('--no-url', action='store_true', help='leave out the text-processing.com label')
+    parser.add_argument('--restart', action='store_true', help='ignore saved progress')
+    parser.add_argument('--sqlite', help='sqlite database instead of the ADB')
+    args = parser.parse_args()
+
+    if args.sqlite:
+        con = sqlite3.connect(args.sqlite, check_same_thread=False)
+    else:
+        con = db.ConnectionPool('twitter-creds.json', size=args.workers + 1)
+    nlp.set_processes(args.processes)
+    try:
+        Rescorer(con, args.table, chunk_size=args.chunk_size, workers=args.workers,
+                 fetch_size=args.fetch_size, url=not args.no_url).run(restart=args.restart)
+    finally:
+        nlp.set_processes(0)
+        con.close()
@@ -0,0 +1,218 @@
+'''
+Concurrent, rate-limit-aware scheduler for historical search.
+Every term keeps its own max_id/since_id cursor and pages independently
+on a small thread pool. Requests draw from a token bucket sized to the
+search endpoint's per-window budget, so we wait instead of getting
+rate-limit errors. Pages are handed back to the caller's thread.
+
+Checks against stubs.FakeSearch (cursors, since_id, rate-limit retry,
+errors raised by on_page):
+    python3 scheduler.py
+'''
+from concurrent.futures import ThreadPoolExecutor
+import queue # Pages from the workers to the caller
+import threading # Token bucket lock
+import time # Refill and backoff
+
+
+class TokenBucket(object):
+    '''
+    Allows capacity requests at once, refilled at capacity per window seconds.
+    Search allows 180 requests per 15 minute window with user auth.
+    '''
+
+    def __init__(self, capacity=180, window=15 * 60):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        # Blocks until a request may be made
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TermCursor(object):
+    '''
+    Paging state of one search term.
+        - max_id: only return tweets at or below this id (next page)
+        - since_id: only return tweets above this id (resume point)
+    '''
+
+    def __init__(self, term, since_id=None):
+        self.term = term
+        self.max_id = None
+        self.since_id = since_id
+        self.pages = 0
+        self.done = False
+
+    def params(self, count=100):
+        params = {'q': self.term, 'count': count, 'include_entities': 'true'}
+        if self.max_id:
+            params['max_id'] = self.max_id
+        if self.since_id:
+            params['since_id'] = self.since_id
+        return params
+
+    def advance(self, result):
+        self.pages += 1
+        try:
+            # Parse the data returned to get max_id to be passed in consequent call.
+            next_results_url_params = result['search_metadata']['next_results']
+            self.max_id = next_results_url_params.split('max_id=')[1].split('&')[0]
+        except (KeyError, IndexError):
+            # No more next pages
+            self.done = True
+        if not result.get('statuses'):
+            self.done = True
+
+
+class FetchScheduler(object):
+    '''
+    search is a callable like Twython.search taking q, count, max_id...
+        - workers: terms queried at the same time
+        - max_pages: pages fetched per term
+    run(on_page) calls on_page(term, result) on the calling thread.
+    '''
+
+    def __init__(self, search, terms, since_ids=None, workers=3, max_pages=20, bucket=None):
+        since_ids = since_ids or {}
+        self.search = search
+        self.cursors = [TermCursor(term, since_ids.get(term)) for term in terms]
+        self.workers = workers
+        self.max_pages = max_pages
+        self.bucket = bucket or TokenBucket()
+        self.requests = 0
+        # Set when run() stops taking pages, so the workers give up
+        self._stop = threading.Event()
+
+    def _request(self, cursor):
+        while True:
+            self.bucket.take()
+            self.requests += 1
+            try:
+                return self.search(**cursor.params())
+            except Exception as e:
+                # TwythonRateLimitError says when the window resets
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is None:
+                    raise
+                # Twython gives the reset time since the epoch
+                reset = int(retry_after)
+                wait = max(1, reset - int(time.time()) if reset > 1e9 else reset)
+                print("Rate limited on", cursor.term, "- waiting", wait, "secs")
+                if self._stop.wait(wait):
+                    return None
+
+    # False if run() stopped taking pages before there was room
+    def _put(self, pages, page):
+        while not self._stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _page_term(self, cursor, pages):
+        try:
+            while not cursor.done and cursor.pages < self.max_pages and not self._stop.is_set():
+                result = self._request(cursor)
+                if result is None:
+                    return
+                cursor.advance(result)
+                if not self._put(pages, (cursor.term, result)):
+                    return
+        except Exception as e:
+            print("Fetch error for", cursor.term, ":", e)
+            cursor.done = True
+
+    def run(self, on_page):
+        self._stop.clear()
+        pages = queue.Queue(maxsize=self.workers * 2)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._page_term, cursor, pages) for cursor in self.cursors]
+            try:
+                while True:
+                    try:
+                        term, result = pages.get(timeout=0.1)
+                    except queue.Empty:
+                        if all(future.done() for future in futures) and pages.empty():
+                            break
+                        continue
+                    on_page(term, result)
+            except BaseException:
+                # Workers blocked on the full queue or a rate limit would
+                # otherwise keep the pool from shutting down
+                self._stop.set()
+                raise
+        return self.requests
+
+
+def check_scheduler():
+    import stubs # FakeSearch
+    bucket = lambda: TokenBucket(capacity=1000, window=1)
+    statuses = {'rams': [{'id': i} for i in range(1250, 1000, -1)],
+                'lakers': [{'id': i} for i in range(2120, 2000, -1)]}
+
+    # Every term pages on its own max_id cursor
+    search = stubs.FakeSearch(statuses)
+    fetcher = FetchScheduler(search, ['rams', 'lakers'], workers=2, bucket=bucket())
+    seen = {'rams': [], 'lakers': []}
+    fetcher.run(lambda term, result: seen[term].extend(status['id'] for status in result['statuses']))
+    assert seen['rams'] == list(range(1250, 1000, -1)) and seen['lakers'] == list(range(2120, 2000, -1))
+    assert {cursor.term: cursor.pages for cursor in fetcher.cursors} == {'rams': 3, 'lakers': 2}
+    assert [call['max_id'] for call in search.calls if call['q'] == 'rams'] == [None, '1150', '1050']
+    print("cursors: ok")
+
+    # since_id resumes after the last saved tweet
+    search = stubs.FakeSearch(statuses)
+    fetcher = FetchScheduler(search, ['rams'], since_ids={'rams': 1200}, bucket=bucket())
+    ids = []
+    fetcher.run(lambda term, result: ids.extend(status['id'] for status in result['statuses']))
+    assert ids == list(range(1250, 1200, -1))
+    assert all(call['since_id'] == 1200 for call in search.calls)
+    print("since_id: ok")
+
+    # A rate limit error waits for the window and retries the same page
+    search = stubs.FakeSearch(statuses, rate_limit=2)
+    fetcher = FetchScheduler(search, ['rams'], bucket=bucket())
+    ids = []
+    fetcher.run(lambda term, result: ids.extend(status['id'] for status in result['statuses']))
+    assert ids == list(range(1250, 1000, -1)) and search.limited == 1 and fetcher.requests == 4
+    print("rate limit retry: ok")
+
+    # An error from on_page reaches the caller instead of hanging on the full queue
+    many = {'rams': [{'id': i} for i in range(100000, 0, -1)]}
+    fetcher = FetchScheduler(stubs.FakeSearch(many), ['rams'], workers=1, max_pages=1000, bucket=bucket())
+    errors = []
+
+    def on_page(term, result):
+        time.sleep(0.05) # Let the worker fill the queue
+        raise KeyError('id')
+
+    def fetch():
+        try:
+            fetcher.run(on_page)
+        except KeyError as e:
+            errors.append(e)
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "run() hung after on_page raised"
+    assert len(errors) == 1
+    print("on_page error: ok")
+
+
+if __name__ == '__main__':
+    check_scheduler()
@@ -0,0 +1,109 @@
+'''
+Adaptive load shedding for the stream.
+During spikes the tracked keywords can produce more tweets than the
+workers can score and insert. LoadShedder turns the queue depth and
+the measured seconds per tweet into a load figure and steps through
+cheaper levels while it stays high, and back once it has been low for
+a while:
+
+    0 full        every scorer runs
+    1 no_url      skip the text-processing.com call
+    2 vader_only  also skip TextBlob
+    3 sample      also keep only 1 in sample_rate retweets
+
+The level is exported as the shed_level gauge, and tweets stored at
+each level are counted (shedding gauge), so downstream analysis can
+account for degraded labels.
+'''
+import threading # Updated by the stream and the workers
+import time # Hold and cooldown
+
+LEVELS = ('full', 'no_url', 'vader_only', 'sample')
+
+
+class LoadShedder(object):
+    '''
+        - max_delay: seconds of backlog (queued tweets x seconds per tweet / workers)
+          counted as full load; a full queue also counts as full load
+        - up: step up a level while load is at least this
+        - down: step down a level once load has stayed at or below this for cooldown seconds
+        - hold: seconds at a level before stepping up again
+        - sample_rate: keep 1 in this many retweets at level 3
+    '''
+
+    def __init__(self, max_delay=5.0, up=0.5, down=0.2, hold=5.0, cooldown=30.0,
+                 sample_rate=10, max_level=len(LEVELS) - 1):
+        self.max_delay = max_delay
+        self.up = up
+        self.down = down
+        self.hold = hold
+        self.cooldown = cooldown
+        self.sample_rate = sample_rate
+        self.max_level = max_level
+        self.level = 0
+        self.load = 0.0
+        self.changes = 0
+        self.sampled_out = 0
+        self.stored = [0] * len(LEVELS)
+        self.seconds_per_tweet = 0.0
+        self._changed = None
+        self._calm_since = None
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'level': LEVELS[self.level], 'load': round(self.load, 3), 'changes': self.changes,
+                'sampled_out': self.sampled_out,
+                'stored': {name: count for name, count in zip(LEVELS, self.stored)}}
+
+    # A worker took seconds to process count tweets
+    def processed(self, count, seconds):
+        if not count:
+            return
+        per_tweet = seconds / count
+        with self._lock:
+            if self.seconds_per_tweet:
+                self.seconds_per_tweet = 0.8 * self.seconds_per_tweet + 0.2 * per_tweet
+            else:
+                self.seconds_per_tweet = per_tweet
+
+    # Recompute the load from the queue and move at most one level
+    def update(self, depth, capacity, workers, now=None):
+        now = time.monotonic() if now is None else now
+        backlog = depth * self.seconds_per_tweet / max(1, workers)
+        load = max(depth / capacity if capacity else 0.0, backlog / self.max_delay)
+        with self._lock:
+            self.load = load
+            if load >= self.up:
+                self._calm_since = None
+                if self.level < self.max_level and (self._changed is None or now - self._changed >= self.hold):
+                    self._set(self.level + 1, now)
+            elif load <= self.down:
+                if self._calm_since is None:
+                    self._calm_since = now
+                elif self.level > 0 and now - self._calm_since >= self.cooldown:
+                    self._set(self.level - 1, now)
+                    self._calm_since = now
+            else:
+                self._calm_since = None
+        return self.level
+
+    def _set(self, level, now):
+        print("Load %.2f: shedding level %s -> %s" % (self.load, LEVELS[self.level], LEVELS[level]))
+        self.level = level
+        self._changed = now
+        self.changes += 1
+
+    # False for a retweet sampled out at level 3
+    def keep(self, data):
+        if self.level < 3 or 'retweeted_status' not in data:
+            return True
+        if data['id'] % self.sample_rate == 0:
+            return True
+        self.sampled_out += 1
+        return False
+
+    # count tweets were stored at level
+    def record(self, level, count):
+        with self._lock:
+            self.stored[level] += count
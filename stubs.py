@@ -0,0 +1,179 @@
+'''
+Local stand-ins for the services Flock talks to, for tests and benchmarks.
+SentimentStub mimics the text-processing.com sentiment endpoint and
+FakeSearch the paginated Twitter search API.
+
+Throughput of the pooled client against the stub:
+    python3 stubs.py [texts] [workers]
+Circuit breaker check (open, single half-open probe, reopen, close):
+    python3 stubs.py check
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json # Encoding stub responses
+import sys # For benchmark arguments
+import threading # Serving in the background
+import time # Simulated latency and timing
+
+
+class SentimentStub(object):
+    '''
+    Serves POST /api/sentiment/ on localhost.
+        - latency: seconds to wait before answering
+        - status: HTTP status to answer with (e.g. 503 to trip the circuit)
+        - label: "neg", "neutral" or "pos"
+    '''
+
+    def __init__(self, latency=0.0, status=200, label='neutral', port=0):
+        self.latency = latency
+        self.status = status
+        self.label = label
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keep-alive
+            # Headers and body go out in separate writes; without TCP_NODELAY
+            # Nagle and delayed ACKs add ~40 ms to every keep-alive request
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.status == 200:
+                    body = json.dumps({'label': stub.label,
+                                       'probability': {'neg': 0.3, 'neutral': 0.4, 'pos': 0.3}})
+                else:
+                    body = 'Throttled'
+                body = body.encode()
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}/api/sentiment/'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeSearch(object):
+    '''
+    Stands in for Twython.search with paginated results.
+    statuses is a dict of term -> statuses, newest first. Pages follow
+    max_id/since_id like the search API and advertise the next page in
+    search_metadata.next_results. With rate_limit, every call after that
+    many in a window raises RateLimitError and starts a new window.
+    '''
+
+    class RateLimitError(Exception):
+        def __init__(self, retry_after):
+            super().__init__('Rate limit exceeded')
+            self.retry_after = retry_after
+
+    def __init__(self, statuses, latency=0.0, rate_limit=None):
+        self.statuses = statuses
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.calls = []
+        self.limited = 0
+        self._window = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, q, count=100, max_id=None, since_id=None, **params):
+        with self._lock:
+            if self.rate_limit is not None and self._window >= self.rate_limit:
+                self._window = 0
+                self.limited += 1
+                raise FakeSearch.RateLimitError(retry_after=1)
+            self._window += 1
+            self.calls.append({'q': q, 'max_id': max_id, 'since_id': since_id})
+        if self.latency:
+            time.sleep(self.latency)
+        matching = [status for status in self.statuses.get(q, [])
+                    if (max_id is None or status['id'] <= int(max_id)) and
+                       (since_id is None or status['id'] > int(since_id))]
+        page = matching[:int(count)]
+        metadata = {'count': len(page), 'query': q}
+        if len(matching) > len(page):
+            metadata['next_results'] = '?max_id={}&q={}&count={}&include_entities=1'.format(
+                page[-1]['id'] - 1, q, count)
+        return {'statuses': page, 'search_metadata': metadata}
+
+
+def bench_sentiment_client(n=200, workers=8, latencies=(0.0, 0.05, 0.2)):
+    import nlp
+    texts = ['this is tweet number %d' % i for i in range(n)]
+    for latency in latencies:
+        with SentimentStub(latency=latency) as stub:
+            client = nlp.SentimentClient(url=stub.url, workers=workers)
+            start = time.perf_counter()
+            client.classify_many(texts)
+            elapsed = time.perf_counter() - start
+            client.close()
+        print("latency %4d ms: %8.1f texts/sec (%d workers)" %
+              (latency * 1000, n / elapsed, workers))
+
+
+def check_circuit_breaker():
+    import nlp
+    with SentimentStub(status=503) as stub:
+        client = nlp.SentimentClient(url=stub.url, workers=8, max_failures=3, cooldown=0.5)
+
+        # Opens after max_failures failed requests, then stops calling the service
+        assert client.classify_many(['a', 'b', 'c']) == [None] * 3
+        assert client.is_open and stub.requests == 3
+        assert client.classify_many(['d'] * 8) == [None] * 8 and stub.requests == 3
+        print("opens after max_failures: ok")
+
+        # Half-open: one probe for all concurrent callers; a failed probe reopens
+        time.sleep(0.6)
+        stub.latency = 0.2
+        assert client.classify_many(['e'] * 8) == [None] * 8
+        assert stub.requests == 4 and client.is_open
+        print("single probe, reopens on failure: ok")
+
+        # A successful probe closes the circuit
+        stub.latency = 0.0
+        stub.status = 200
+        assert client.classify('f') is None and stub.requests == 4 # still cooling down
+        time.sleep(0.6)
+        assert client.classify('g') == 'neutral' and not client.is_open
+        assert client.classify_many(['h'] * 4) == ['neutral'] * 4 and stub.requests == 9
+        print("closes after a good probe: ok")
+        client.close()
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    if argv[1:] == ['check']:
+        check_circuit_breaker()
+        sys.exit(0)
+    n = int(argv[1]) if len(argv) > 1 else 200
+    workers = int(argv[2]) if len(argv) > 2 else 8
+    bench_sentiment_client(n, workers)
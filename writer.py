@@ -0,0 +1,370 @@
+'''
+Batched writer for tweet rows.
+Rows are buffered and inserted with a single executemany and one
+commit per batch. A background thread flushes when the batch is full
+or when the oldest buffered row is older than the flush interval.
+
+Works against cx_Oracle (Autonomous DB) or a sqlite3 stand-in with
+the same column layout as flock.create_stream_db:
+    python3 writer.py [rows] [batch_size]
+Rejected rows, the row by row retry and checkpoints against sqlite:
+    python3 writer.py check
+'''
+from collections import Counter # Term frequencies
+from contextlib import nullcontext
+import datetime # Timestamps in the error log
+import metrics # Flush latency
+import os # Benchmark database paths
+import sqlite3 # Stand-in database
+import sys # For benchmark arguments
+import tempfile # Benchmark databases
+import threading # Background flushing
+import time # Flush interval
+
+COLUMNS = ['ID', 'TWEET_DATE', 'HASHTAGS', 'TEXT', 'TWITTER_USER',
+           'FOLLOWERS', 'FOLLOWING', 'FAVORITE_COUNT', 'RETWEET_COUNT',
+           'USER_LOC', 'KEYWORD', 'NEGATIVE', 'NEUTRAL', 'POSITIVE']
+
+# Tweet attributes in COLUMNS order; Tweet.to_row gives a tuple of them
+BINDS = ['id', 'tweet_date', 'hashtags', 'text', 'twitter_user',
+         'followers', 'following', 'favorites', 'retweets',
+         'user_loc', 'keyword', 'negative', 'neutral', 'positive']
+# Positions in a row tuple
+ID, TWEET_DATE, KEYWORD = 0, 1, 10
+
+
+# Rows are bound by position, so no dict is built per row
+def insert_sql(table, sqlite=False):
+    if sqlite:
+        values = ['?'] * len(COLUMNS)
+    else:
+        values = [':' + str(position + 1) for position in range(len(COLUMNS))]
+        values[TWEET_DATE] = 'to_date(:2, \'Dy Mon dd hh24:mi:ss "+0000" yyyy\')'
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(table, ','.join(COLUMNS), ','.join(values))
+
+
+'''
+SQLite table with the same layout as create_stream_db
+'''
+def create_sqlite_stream_db(con, name):
+    con.execute('''create table if not exists {}
+                (ID INTEGER,
+                 TWEET_DATE TEXT,
+                 HASHTAGS VARCHAR(400),
+                 TEXT VARCHAR(400),
+                 TWITTER_USER VARCHAR(28),
+                 FOLLOWERS INTEGER,
+                 FOLLOWING INTEGER,
+                 FAVORITE_COUNT INTEGER,
+                 RETWEET_COUNT INTEGER,
+                 USER_LOC VARCHAR(28),
+                 KEYWORD VARCHAR(100),
+                 NEGATIVE INTEGER,
+                 NEUTRAL INTEGER,
+                 POSITIVE INTEGER)'''.format(name))
+    con.commit()
+
+
+def log_row_error(row, message, error_log='errors.txt'):
+    with open(error_log, 'a') as f:
+        f.write('-'*7 + 'Insert' + '-'*7)
+        f.write(str(datetime.datetime.now()) + ': Row rejected: ' + str(message).strip() + '\n')
+        f.write(repr(row) + '\n')
+        f.write('-'*20 + '\n')
+
+
+class BatchWriter(object):
+    '''
+    Buffers rows (tuples in COLUMNS order) for one table.
+    con is a db.ConnectionPool (a session is acquired per flush) or a
+    sqlite3 connection.
+        - batch_size: flush as soon as this many rows are buffered
+        - interval: flush rows that have waited this many seconds
+        - checkpoints: checkpoint.CheckpointStore updated in each batch's transaction
+    Call close() on shutdown to flush what is left.
+    '''
+
+    def __init__(self, con, table, batch_size=500, interval=2.0, error_log='errors.txt',
+                 checkpoints=None):
+        self.con = con
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.error_log = error_log
+        self.checkpoints = checkpoints
+        self.sqlite = isinstance(con, sqlite3.Connection)
+        self.sql = insert_sql(table, self.sqlite)
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.batches = 0
+        self._rows = []
+        self._terms = [] # search term of each row, None from the stream
+        self._oldest = None
+        self._lock = threading.Lock() # guards _rows and _terms
+        self._db_lock = threading.Lock() # one flush at a time
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='BatchWriter-' + table, daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    def add(self, row, term=None):
+        with self._lock:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(row)
+            self._terms.append(term)
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                due = self._rows and (len(self._rows) >= self.batch_size or
+                                      time.monotonic() - self._oldest >= self.interval)
+            if due:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            terms, self._terms = self._terms, []
+        if not rows:
+            return 0
+        start = time.perf_counter()
+        with self._db_lock:
+            # A dead pooled session is dropped by the pool, so retry once on a fresh one
+            attempts = 1 if self.sqlite else 2
+            for attempt in range(attempts):
+                try:
+                    self._write(rows, terms)
+                    break
+                except Exception as e:
+                    print("BatchWriter flush error: ", e)
+                    if attempt + 1 == attempts:
+                        for row in rows:
+                            log_row_error(row, e, self.error_log)
+                        self.rows_rejected += len(rows)
+        metrics.observe('adb_flush', time.perf_counter() - start)
+        return len(rows)
+
+    def _connection(self):
+        if self.sqlite:
+            return nullcontext(self.con)
+        return self.con.connection()
+
+    def _write(self, rows, terms):
+        with self._connection() as con:
+            self._write_batch(con, rows, terms)
+
+    def _write_batch(self, con, rows, terms):
+        cursor = con.cursor()
+        rejected = {} # position in rows -> error message
+        if self.sqlite:
+            # sqlite3 has no batch errors, so retry a failed batch row by row
+            try:
+                cursor.executemany(self.sql, rows)
+            except sqlite3.Error:
+                con.rollback()
+                for offset, row in enumerate(rows):
+                    try:
+                        cursor.execute(self.sql, row)
+                    except sqlite3.Error as e:
+                        rejected[offset] = e
+        else:
+            cursor.executemany(self.sql, rows, batcherrors=True)
+            rejected = {error.offset: error.message for error in cursor.getbatcherrors()}
+        if self.checkpoints is not None:
+            accepted = [offset for offset in range(len(rows)) if offset not in rejected]
+            self.checkpoints.update(con, self.table, [rows[offset] for offset in accepted],
+                                    [terms[offset] for offset in accepted])
+        con.commit()
+
+        for offset, message in rejected.items():
+            log_row_error(rows[offset], message, self.error_log)
+        self.rows_rejected += len(rejected)
+        self.rows_written += len(rows) - len(rejected)
+        self.batches += 1
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+
+def freq_upsert_sql(table, sqlite=False):
+    if sqlite:
+        return ("INSERT INTO {0} (TWEET_DATE, TOKEN, COUNT) VALUES (:tweet_date, :token, :cnt) "
+                "ON CONFLICT(TWEET_DATE, TOKEN) DO UPDATE SET COUNT = COUNT + excluded.COUNT").format(table)
+    return """MERGE INTO {0} f
+              USING (SELECT :tweet_date TWEET_DATE, :token TOKEN, :cnt CNT FROM dual) s
+              ON (f.TWEET_DATE = s.TWEET_DATE AND f.TOKEN = s.TOKEN)
+              WHEN MATCHED THEN UPDATE SET f.COUNT = f.COUNT + s.CNT
+              WHEN NOT MATCHED THEN INSERT (TWEET_DATE, TOKEN, COUNT)
+                                    VALUES (s.TWEET_DATE, s.TOKEN, s.CNT)""".format(table)
+
+
+'''
+SQLite table with the same layout as create_freq_db, plus the
+unique key the upsert needs
+'''
+def create_sqlite_freq_db(con, name):
+    con.execute('''create table if not exists {}
+                (TWEET_DATE TEXT,
+                 TOKEN VARCHAR(280),
+                 COUNT INTEGER)'''.format(name))
+    con.execute('create unique index if not exists {0}_key on {0} (TWEET_DATE, TOKEN)'.format(name))
+    con.commit()
+
+
+class FreqWriter(object):
+    '''
+    Counts tokens per (date, token) in memory and upserts the totals
+    into a term-frequency table every interval seconds.
+    con is a db.ConnectionPool or a sqlite3 connection, as for BatchWriter.
+    Call close() on shutdown to flush what is left.
+    '''
+
+    def __init__(self, con, table='tweet_freqs', interval=60.0, error_log='errors.txt'):
+        self.con = con
+        self.table = table
+        self.interval = interval
+        self.error_log = error_log
+        self.sqlite = isinstance(con, sqlite3.Connection)
+        self.sql = freq_upsert_sql(table, self.sqlite)
+        self.tokens_counted = 0
+        self.rows_written = 0
+        self._counts = Counter()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='FreqWriter-' + table, daemon=True)
+        self._thread.start()
+
+    def add(self, date, tokens):
+        with self._lock:
+            counts = self._counts
+            for token in tokens:
+                counts[(date, token)] += 1
+            self.tokens_counted += len(tokens)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return 0
+        rows = [{'tweet_date': date.isoformat(' ') if self.sqlite else date,
+                 'token': token, 'cnt': count}
+                for (date, token), count in counts.items()]
+        with self._db_lock:
+            try:
+                if self.sqlite:
+                    con = self.con
+                    con.executemany(self.sql, rows)
+                    con.commit()
+                else:
+                    with self.con.connection() as con:
+                        con.cursor().executemany(self.sql, rows)
+                        con.commit()
+                self.rows_written += len(rows)
+            except Exception as e:
+                print("FreqWriter flush error: ", e)
+                log_row_error('%d token counts' % len(rows), e, self.error_log)
+        return len(rows)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+
+def bench_writer(n=20000, batch_size=500):
+    row = (1, 'Thu Jun 20 18:00:00 +0000 2019', "['rams']", 'go rams go', 'casey',
+           10, 20, 0, 0, 'Earth', 'rams', 0, 0, 1)
+
+    # On disk, so each commit costs what it would on a real database
+    tmp = tempfile.mkdtemp()
+    con = sqlite3.connect(os.path.join(tmp, 'rows.db'), check_same_thread=False)
+    create_sqlite_stream_db(con, 'tweets')
+    sql = insert_sql('tweets', sqlite=True)
+    start = time.perf_counter()
+    for i in range(n):
+        con.execute(sql, (i,) + row[1:])
+        con.commit()
+    elapsed = time.perf_counter() - start
+    print("row at a time: %10.1f rows/sec" % (n / elapsed))
+
+    con = sqlite3.connect(os.path.join(tmp, 'batched.db'), check_same_thread=False)
+    create_sqlite_stream_db(con, 'tweets')
+    writer = BatchWriter(con, 'tweets', batch_size=batch_size)
+    start = time.perf_counter()
+    for i in range(n):
+        writer.add((i,) + row[1:])
+    writer.close()
+    elapsed = time.perf_counter() - start
+    print("batched (%d):  %10.1f rows/sec" % (batch_size, n / elapsed))
+
+
+def check_writer():
+    import checkpoint # Imports writer
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'check.db')
+    error_log = os.path.join(tmp, 'errors.txt')
+    con = sqlite3.connect(path, check_same_thread=False)
+    create_sqlite_stream_db(con, 'tweets')
+    # Rows with negative followers fail, so a batch holding one is retried row by row
+    con.execute('''create trigger reject_negative before insert on tweets
+                   when NEW.FOLLOWERS < 0 begin select raise(abort, 'negative followers'); end''')
+    con.commit()
+    checkpoints = checkpoint.CheckpointStore(con)
+    checkpoints.create()
+    writer = BatchWriter(con, 'tweets', batch_size=10, error_log=error_log, checkpoints=checkpoints)
+
+    row = (0, 'Thu Jun 20 18:00:00 +0000 2019', "['rams']", 'go rams go', 'casey',
+           10, 20, 0, 0, 'Earth', 'rams', 0, 0, 1)
+    rejected = {7, 15, 29} # 29 is the highest id, so it must not move the checkpoint
+    for i in range(30):
+        followers = -1 if i in rejected else 10
+        keyword = 'rams' if i % 2 else 'lakers'
+        writer.add((i,) + row[1:5] + (followers,) + row[6:10] + (keyword,) + row[11:],
+                   'go rams' if keyword == 'rams' else None)
+    writer.close()
+
+    assert writer.rows_written == 27 and writer.rows_rejected == 3, (writer.rows_written, writer.rows_rejected)
+    with open(error_log, 'r') as f:
+        logged = f.read()
+    assert logged.count('Row rejected: negative followers') == 3
+    assert all('(%d, ' % i in logged for i in rejected)
+    print("rejected rows: ok")
+
+    # A second connection only sees what was committed
+    check = sqlite3.connect(path)
+    ids = sorted(row[0] for row in check.execute('select ID from tweets'))
+    assert ids == [i for i in range(30) if i not in rejected]
+    marks = {(label, term): max_id for table, label, term, max_id, date
+             in check.execute('select * from {}'.format(checkpoint.TABLE))}
+    assert marks == {('rams', 'go rams'): 27, ('lakers', '*'): 28}, marks
+    print("row by row retry and committed checkpoints: ok")
+    check.close()
+    con.close()
+
+
+if __name__ == '__main__':
+    argv = sys.argv
+    if argv[1:] == ['check']:
+        check_writer()
+        sys.exit(0)
+    n = int(argv[1]) if len(argv) > 1 else 20000
+    batch_size = int(argv[2]) if len(argv) > 2 else 500
+    bench_writer(n, batch_size)